@@ -0,0 +1,68 @@
+"""
+Compares the per-video overhead of running the yt-dlp CLI
+(a new process for every video, like the worker used to do)
+with ytcl's in-process YtdlService, which keeps a warm YoutubeDL.
+
+Only the info extraction is timed, since the actual download takes the same time
+either way.
+Importing ytcl opens the library's database, so run this from a library folder:
+
+    python path/to/benchmarks/ytdlp_overhead.py VIDEO_ID [VIDEO_ID ...]
+"""
+
+import argparse
+import statistics
+import subprocess
+import time
+
+from ytcl.common import YT_DLP_CMD
+from ytcl.ytdl_service import YtdlService
+
+
+def time_subprocess(url):
+    start = time.perf_counter()
+    subprocess.run(
+        [YT_DLP_CMD, '--simulate', '--quiet', '--no-warnings', url],
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def time_service(service: YtdlService, url):
+    start = time.perf_counter()
+    service.extract_info(url)
+    return time.perf_counter() - start
+
+
+def summarize(name, timings):
+    first, rest = timings[0], timings[1:] or timings
+    print(
+        f"{name:<12} first: {first:6.2f}s   "
+        f"after that: {statistics.mean(rest):6.2f}s/video (n={len(rest)})"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('ytids', nargs='+')
+    parser.add_argument(
+        '--rounds', type=int, default=1, help="go through the videos this many times"
+    )
+    args = parser.parse_args()
+    urls = [f'https://www.youtube.com/watch?v={ytid}' for ytid in args.ytids]
+    urls *= args.rounds
+
+    service = YtdlService(num_threads=1)
+    # alternate, so that both see the same network conditions
+    subprocess_timings = []
+    service_timings = []
+    for url in urls:
+        subprocess_timings.append(time_subprocess(url))
+        service_timings.append(time_service(service, url))
+
+    summarize('subprocess', subprocess_timings)
+    summarize('in-process', service_timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
-import itertools
+import asyncio
+import contextlib
 import json
 import logging
 import math
@@ -7,9 +8,9 @@ import random
 import subprocess
 import sys
 import time
-import urllib.error
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import List, Optional
 from unittest import mock
 import argparse
 
@@ -28,17 +29,19 @@ from starlette.responses import (
 )
 from starlette.routing import Mount
 from starlette.routing import Route
-from starlette.staticfiles import StaticFiles
 from starlette.background import BackgroundTask
+from . import file_index
+from . import media
 from . import tasks
+from . import thumbnail_pack
+from . import wakeup
 from . import youtube_api
 from .common import (
     VIDEOS_ROOT,
     FILES_ROOT,
     call,
     path2url,
-    download_video_thumbnail,
-    download_video_thumbnails,
+    download_thumbnails,
     SUBCOMMANDS,
     YTIDS_TO_IGNORE,
     BRAND_NAME,
@@ -50,10 +53,17 @@ from .models import (
     db,
     Channel,
     Video,
+    VideoSearch,
+    ChannelStats,
+    ApiCache,
+    QuotaLedger,
+    RateLimiter,
+    PackedThumbnail,
+    quota_day,
+    create_search_triggers,
     QueuedTask,
+    TASK_STATUS,
     get_downloaded_paths,
-    get_all_downloaded_paths,
-    get_all_preview_paths,
     IgnoreTerm,
     DOWNLOAD_STATUS,
 )
@@ -61,7 +71,13 @@ from . import youtube_api
 
 print_function = print
 
-loader = ibis.loaders.FileReloader(Path(__file__).parent.joinpath("templates"))
+_TEMPLATES_DIR = Path(__file__).parent.joinpath("templates")
+# FileReloader stats the template file every time it's used,
+# which is only worth it while editing templates.
+if os.getenv("YTCL_DEV"):
+    loader = ibis.loaders.FileReloader(_TEMPLATES_DIR)
+else:
+    loader = ibis.loaders.FileLoader(_TEMPLATES_DIR)
 
 
 @register("static")
@@ -71,7 +87,7 @@ class StaticNode(Node):
         self.path_expr = Expression(path, token)
 
     def wrender(self, context):
-        return app.router.url_path_for("static", path=self.path_expr.eval(context))
+        return static(self.path_expr.eval(context))
 
 
 @register("url")
@@ -97,14 +113,32 @@ def render_to_response(template_name, ctx) -> HTMLResponse:
 
 class Index(HTTPEndpoint):
     def get(self, request: Request):
-        channels = Channel.select().order_by(Channel.local_view_count.desc())
-        channels = list(channels)
-        channels.sort(
-            key=lambda c: (c.local_view_count, c.num_local_videos()), reverse=True
+        # notice files that changed since the last check,
+        # so their channel's stats get refreshed.
+        file_index.downloaded.refresh()
+        file_index.previews.refresh()
+        ChannelStats.refresh_missing()
+
+        channels = list(
+            Channel.select(Channel, ChannelStats)
+            .join(ChannelStats, attr='stats')
+            .order_by(
+                Channel.local_view_count.desc(), ChannelStats.num_local_videos.desc()
+            )
         )
+        preview_ytids = []
+        for c in channels:
+            preview_ytids += c.stats.preview_ytid_list()
+        preview_videos = {
+            v.ytid: v for v in Video.select().where(Video.ytid.in_(preview_ytids))
+        }
         for c in channels:
             c: Channel
-            tmp_preview_videos = list(itertools.islice(c.urls_of_preview_videos(), 2))
+            tmp_preview_videos = [
+                preview_videos[ytid]
+                for ytid in c.stats.preview_ytid_list()
+                if ytid in preview_videos
+            ]
             if tmp_preview_videos:
                 c.tmp_display_orientation = tmp_preview_videos[0].display_orientation()
             c.tmp_preview_videos = tmp_preview_videos
@@ -125,7 +159,7 @@ class AddChannel(HTTPEndpoint):
         video_url = form_data["video_url"]
         auto_download_previews = bool(form_data.get("auto_download_previews"))
 
-        channel_data = youtube_api.get_channel_from_video_url(video_url)
+        channel_data = await youtube_api.get_channel_from_video_url(video_url)
 
         try:
             channel = Channel.create(
@@ -155,8 +189,8 @@ class BrowseChannel(HTTPEndpoint):
         channel_id = request.path_params["channel_id"]
         page_number = int(request.query_params.get("page", "1"))
         channel = Channel.get_by_id(channel_id)
-        downloaded_ytids = set(p.stem for p in channel.local_video_paths())
-        preview_ytids = set(p.stem for p in channel.preview_video_paths())
+        downloaded_ytids = file_index.downloaded.ytids(channel.id)
+        preview_ytids = file_index.previews.ytids(channel.id)
 
         model_videos = [
             v
@@ -258,21 +292,16 @@ class BrowseChannel(HTTPEndpoint):
             Low_Res=low_res,
         )
 
-        ignore_terms = IgnoreTerm.all_terms()
+        cards = VideoCards(
+            downloaded_ytids=downloaded_ytids,
+            show_static_thumbnails=get_show_static_thumbnails(request),
+            preview_version_ytids=preview_ytids,
+            ignore_terms=IgnoreTerm.all_terms(),
+        )
         section_htmls = {}
         for name, videos in sections.items():
             if videos:
-                htmls = []
-                for video in videos:
-                    html = mk_video_html(
-                        video,
-                        downloaded_ytids=downloaded_ytids,
-                        show_static_thumbnails=get_show_static_thumbnails(request),
-                        preview_version_ytids=preview_ytids,
-                        ignore_terms=ignore_terms,
-                    )
-                    if html:
-                        htmls.append(html)
+                htmls = cards.render_all(videos)
                 if htmls:
                     section_htmls[name] = htmls
 
@@ -309,10 +338,10 @@ def is_ignorable(title, ignore_terms):
     return any(s.lower() in title.lower() for s in ignore_terms)
 
 
-async def wrapper_for_fetch_generator(channels, downloaded_ytids, first_page_only=True):
+async def wrapper_for_fetch_generator(channels, downloaded_ytids, force_full_sync=False):
     try:
         async for chunk in video_fetch_generator(
-            channels, downloaded_ytids, first_page_only
+            channels, downloaded_ytids, force_full_sync
         ):
             yield chunk
     except Exception:
@@ -320,7 +349,54 @@ async def wrapper_for_fetch_generator(channels, downloaded_ytids, first_page_onl
         raise
 
 
-async def video_fetch_generator(channels, downloaded_ytids, first_page_only=True):
+def full_sync_costs() -> dict:
+    """channel id -> estimated API quota for going through all its uploads"""
+    num_videos = dict(
+        Video.select(Video.channel, peewee.fn.COUNT(Video.ytid))
+        .group_by(Video.channel)
+        .tuples()
+    )
+    return {
+        channel_id: youtube_api.estimate_quota_cost(
+            max(math.ceil(n / youtube_api.YOUTUBE_VIDEOS_PER_PAGE), 1)
+        )
+        for channel_id, n in num_videos.items()
+    }
+
+
+def plan_sync(channels, force_full_sync=False):
+    """
+    decide which channels get a full sync, and which don't fit in
+    today's remaining API quota at all.
+    a full sync is only done when asked for (the channel page's button),
+    or in the background by full_sync_loop if that is turned on.
+    channels should be sorted by priority, since the ones at the end are
+    the first to be downgraded to an incremental sync or skipped.
+    """
+    budget = QuotaLedger.remaining_today()
+    full_costs = full_sync_costs() if force_full_sync else {}
+    incremental_cost = youtube_api.estimate_quota_cost(1)
+    full_sync_channels = set()
+    skipped_channels = []
+    for channel in channels:
+        if force_full_sync:
+            full_cost = full_costs.get(channel.id, incremental_cost)
+            if full_cost <= budget:
+                full_sync_channels.add(channel)
+                budget -= full_cost
+                continue
+        if incremental_cost <= budget:
+            budget -= incremental_cost
+        else:
+            skipped_channels.append(channel)
+    return full_sync_channels, skipped_channels
+
+
+async def video_fetch_generator(channels, downloaded_ytids, force_full_sync=False):
+    """
+    channels only fetch the videos added since their last update,
+    unless force_full_sync (see also full_sync_loop).
+    """
     # item['contentDetails']['videoId']
 
     yield f"""
@@ -339,89 +415,103 @@ async def video_fetch_generator(channels, downloaded_ytids, first_page_only=True
     FLEX_DIV_BEGIN = """<div class="gallery">"""
     FLEX_DIV_END = """</div>"""
 
-    ignore_terms = IgnoreTerm.all_terms()
-
-    channel_page_generators = {
-        channel: youtube_api.list_videos_by_page(channel.id) for channel in channels
-    }
+    ignore_terms = await asyncio.to_thread(IgnoreTerm.all_terms)
+    cards = VideoCards(
+        downloaded_ytids=downloaded_ytids,
+        ignore_terms=ignore_terms,
+        show_static_thumbnails=True,
+        show_channel=True,
+        preview_version_ytids=set(),
+    )
 
-    model_videos = {v.ytid: v for v in Video.select()}
+    full_sync_channels, skipped_channels = await asyncio.to_thread(
+        plan_sync, channels, force_full_sync
+    )
+    if skipped_channels:
+        yield f"""<p>Not enough API quota left today for {len(skipped_channels)} channels:
+        {', '.join(c.name for c in skipped_channels)}.
+        See the <a href="/status">status page</a>.</p>"""
+    # the known ytids of each channel's latest page,
+    # so that ingest_page doesn't have to look them up again.
+    known_ytids = {}
+
+    def find_known_ytids(channel):
+        def find(ytids):
+            known_ytids[channel] = Video.known_ytids(ytids)
+            return known_ytids[channel]
+
+        return find
+
+    channel_page_generators = {}
+    for channel in channels:
+        if channel in skipped_channels:
+            continue
+        if channel in full_sync_channels:
+            gen = youtube_api.list_videos_by_page(channel.id)
+        else:
+            gen = youtube_api.list_videos_by_page(
+                channel.id,
+                find_known_ytids=find_known_ytids(channel),
+                newest_known_ytid=channel.newest_ytid,
+                newest_known_published_at=channel.newest_published_at,
+            )
+        channel_page_generators[channel] = gen
+    # the first item of each channel's first page
+    newest_items = {}
 
     yield FLEX_DIV_BEGIN
 
     # run the searches in parallel so that we get some variety
     # in downloaded content.
     videos_processed = 0
-    while channel_page_generators:
-        for channel, gen in list(channel_page_generators.items()):
-            try:
-                page = await gen.__anext__()
-            except urllib.error.HTTPError as exc:
-                if exc.code == 404:
-                    del channel_page_generators[channel]
-                    continue
+    merged = youtube_api.merge_page_generators(
+        channel_page_generators,
+        concurrency=common.REFRESH_CONCURRENCY,
+    )
+    async for channel, page, exc in merged:
+        if page is None and exc is None:
+            # only move the cursor once the channel is done, otherwise
+            # an interrupted update would skip the older new videos next time.
+            await asyncio.to_thread(
+                channel.save_sync_cursor,
+                newest_items.get(channel),
+                full=channel in full_sync_channels,
+            )
+            continue
+        if isinstance(exc, youtube_api.QuotaExceededError):
+            # the other channels would fail the same way
+            await merged.aclose()
+            yield FLEX_DIV_END
+            yield """<p>Stopped: the daily YouTube API quota is used up.
+            See the <a href="/status">status page</a>.</p>"""
+            yield "</body></html>"
+            return
+        if exc is not None:
             # channel could have been deleted.
-            except StopAsyncIteration:
-                del channel_page_generators[channel]
+            if isinstance(exc, youtube_api.APIError) and exc.code == 404:
                 continue
-            except youtube_api.ChannelNotFoundError:
-                del channel_page_generators[channel]
+            if isinstance(exc, youtube_api.ChannelNotFoundError):
                 yield f"<p>Channel not found on YouTube: {channel.name}.</p>"
                 continue
+            raise exc
 
-            new_d1s = []
-            for d1 in page:
-                ytid = d1["id"]
-                if ytid in model_videos:
-                    video = model_videos[ytid]
-
-                    for k, v in mk_video_model_fields(d1).items():
-                        setattr(video, k, v)
-                    video.save()
-                    # we update the stats, but don't show the videos.
-                    # that makes it clearer to see what videos are new,
-                    # without having to mark them somehow.
-                    # videos getting stats updated is a side effect.
-                    # you can ensure stats are updated by loading tha channel
-                    # and waiting for it to complete.
-                    # if video.is_recent():
-                    #     videos_to_show.append(video)
-                else:
-                    if is_ignorable(d1["snippet"]["title"], ignore_terms):
-                        continue
-                    new_d1s.append(d1)
-                    ytid = d1["id"]
-
-                    video = Video.create(
-                        **mk_video_model_fields(d1),
-                        channel=channel,
-                        ytid=ytid,
-                    )
-                    # it might be overkill to download the 1-second previews
-                    # for all videos. you might have a huge number of channels/videos,
-                    # and those 1-second videos are not useful in all cases.
-                    # maybe we should have a button specifically for that.
-                    if channel.auto_download_previews:
-                        video.schedule_download_preview()
-
-                    # before i put mk_video_html calls in a separate loop
-                    # after the were all loaded from yt-dlp,
-                    # but it's better to do it immediately so there's no waiting
-                    # until results start showing.
-                    html = mk_video_html(
-                        video,
-                        downloaded_ytids=downloaded_ytids,
-                        ignore_terms=ignore_terms,
-                        show_static_thumbnails=True,
-                        show_channel=True,
-                        preview_version_ytids=[],
-                    )
-                    if html:
-                        yield html
-            videos_processed += youtube_api.YOUTUBE_VIDEOS_PER_PAGE
-            yield f"<p>Checked {videos_processed} newest videos...</p>"
-        if first_page_only:
-            break
+        if page and channel not in newest_items:
+            newest_items[channel] = max(page, key=lambda d1: d1["snippet"]["publishedAt"])
+
+        new_videos = await asyncio.to_thread(
+            ingest_page, channel, page, ignore_terms, known_ytids.pop(channel, None)
+        )
+        # render each page's cards as soon as it arrives,
+        # rather than after all channels are done,
+        # so there's no waiting until results start showing.
+        for video in new_videos:
+            html = cards.render(video)
+            if html:
+                yield html
+        if new_videos:
+            await asyncio.to_thread(ChannelStats.refresh, channel.id)
+        videos_processed += youtube_api.YOUTUBE_VIDEOS_PER_PAGE
+        yield f"<p>Checked {videos_processed} newest videos...</p>"
 
     yield FLEX_DIV_END
     yield "<p>Done updating.</p>"
@@ -429,22 +519,91 @@ async def video_fetch_generator(channels, downloaded_ytids, first_page_only=True
     yield "</body></html>"
 
 
+# how often the server looks for channels that are due for a full sync
+FULL_SYNC_CHECK_INTERVAL = 60 * 60
+
+
+def plan_full_syncs() -> List[Channel]:
+    """
+    the channels that are due for a full sync, longest overdue first.
+    it leaves enough of today's quota for an incremental update of every channel,
+    so that a full sync never gets in the way of getting new videos.
+    """
+    channels = list(Channel.select())
+    full_costs = full_sync_costs()
+    incremental_cost = youtube_api.estimate_quota_cost(1)
+    budget = QuotaLedger.remaining_today() - incremental_cost * len(channels)
+    due = sorted(
+        (channel for channel in channels if channel.needs_full_sync()),
+        key=lambda channel: channel.last_full_sync_epoch or 0,
+    )
+    planned = []
+    for channel in due:
+        full_cost = full_costs.get(channel.id, incremental_cost)
+        if full_cost <= budget:
+            planned.append(channel)
+            budget -= full_cost
+    return planned
+
+
+async def full_sync(channel: Channel):
+    """
+    goes through all the channel's uploads, refreshing their stats
+    and picking up videos that are older than the sync cursor,
+    e.g. ones that were made public long after they were uploaded.
+    """
+    ignore_terms = await asyncio.to_thread(IgnoreTerm.all_terms)
+    newest_item = None
+    async for page in youtube_api.list_videos_by_page(channel.id):
+        if page and newest_item is None:
+            newest_item = max(page, key=lambda d1: d1["snippet"]["publishedAt"])
+        new_videos = await asyncio.to_thread(ingest_page, channel, page, ignore_terms)
+        if new_videos:
+            await asyncio.to_thread(ChannelStats.refresh, channel.id)
+    await asyncio.to_thread(channel.save_sync_cursor, newest_item, full=True)
+
+
+async def full_sync_loop():
+    """
+    runs in the background for as long as the server is up,
+    so that updating from YouTube only has to fetch what's new.
+    one channel at a time, since there's no hurry.
+    off unless full_sync_days is set in settings.toml.
+    """
+    if not common.FULL_SYNC_DAYS:
+        return
+    while True:
+        try:
+            for channel in await asyncio.to_thread(plan_full_syncs):
+                try:
+                    await full_sync(channel)
+                except youtube_api.QuotaExceededError:
+                    break
+                except Exception as exc:
+                    # e.g. the channel was deleted. it's tried again next time.
+                    print_function(f"Full sync of {channel.name} failed: {exc!r}")
+        except Exception as exc:
+            # e.g. the database was locked. the loop has to keep going.
+            print_function(f"Planning full syncs failed: {exc!r}")
+        await asyncio.sleep(FULL_SYNC_CHECK_INTERVAL)
+
+
 class Search(HTTPEndpoint):
     def get(self, request: Request):
         search_term = request.query_params["search_term"].strip()
         num_results = 0
-        downloaded_ytids = set(p.stem for p in get_all_downloaded_paths())
+        downloaded_ytids = file_index.downloaded.ytids()
         downloaded_video_htmls = []
         video_htmls = []
 
-        preview_ytids = set()
-        for root in [common.PREVIEW_ROOT, common.PREVIEW_SHORT_ROOT]:
-            preview_ytids.update([p.stem for p in root.glob("**/*.*")])
+        preview_ytids = file_index.previews.ytids()
 
         order_by_date_str = request.query_params.get(
             SEARCH_ORDER_BY_DATE_COOKIE
         ) or request.cookies.get(SEARCH_ORDER_BY_DATE_COOKIE, "0")
         order_by_date_bool = order_by_date_str == "1"
+        order_by_relevance_bool = order_by_date_str == SEARCH_ORDER_BY_RELEVANCE
+        order_by_likes_bool = not (order_by_date_bool or order_by_relevance_bool)
 
         channels = Channel.select()
 
@@ -455,11 +614,7 @@ class Search(HTTPEndpoint):
         if search_term:
             ignore_terms = IgnoreTerm.all_terms()
 
-            word1, *rest = search_term.split()
-            where_clause = [Video.title.contains(word1)]
-            for word in rest:
-                # why use the bitwise op? why not pass a *list to .where?
-                where_clause.append(Video.title.contains(word))
+            where_clause = []
 
             channels_to_include = request.query_params.get("channels_to_include")
             channels_to_exclude = request.query_params.get("channels_to_exclude")
@@ -491,21 +646,26 @@ class Search(HTTPEndpoint):
                 filter_widget_expanded = True
 
             if order_by_date_bool:
-                order_by = Video.published_at.desc()
+                order_by = [Video.published_at.desc()]
+            elif order_by_relevance_bool:
+                order_by = [VideoSearch.bm25(), Video.yt_like_count.desc()]
             else:
-                order_by = Video.yt_like_count.desc()
+                order_by = [Video.yt_like_count.desc()]
 
-            videos = [v for v in Video.select().where(*where_clause).order_by(order_by)]
+            qs = with_channels(Video.search(search_term))
+            if where_clause:
+                qs = qs.where(*where_clause)
+            videos = list(qs.order_by(*order_by))
 
+            cards = VideoCards(
+                downloaded_ytids=downloaded_ytids,
+                ignore_terms=ignore_terms,
+                show_channel=True,
+                preview_version_ytids=preview_ytids,
+                show_static_thumbnails=get_show_static_thumbnails(request),
+            )
             for video in videos:
-                html = mk_video_html(
-                    video,
-                    downloaded_ytids=downloaded_ytids,
-                    ignore_terms=ignore_terms,
-                    show_channel=True,
-                    preview_version_ytids=preview_ytids,
-                    show_static_thumbnails=get_show_static_thumbnails(request),
-                )
+                html = cards.render(video)
                 if html:
                     num_results += 1
                     if video.ytid in downloaded_ytids:
@@ -522,6 +682,8 @@ class Search(HTTPEndpoint):
             num_results=num_results,
             downloaded_video_htmls=downloaded_video_htmls,
             order_by_date_bool=order_by_date_bool,
+            order_by_relevance_bool=order_by_relevance_bool,
+            order_by_likes_bool=order_by_likes_bool,
             channels=channels,
             filter_widget_expanded=filter_widget_expanded,
             BRAND_NAME=BRAND_NAME,
@@ -534,6 +696,14 @@ class Search(HTTPEndpoint):
         return resp
 
 
+def with_channels(qs):
+    """
+    for pages that list videos from many channels.
+    otherwise each card's video.channel is a separate query.
+    """
+    return qs.select_extend(Channel).switch(Video).join(Channel)
+
+
 def parse_html_date_input(value) -> datetime:
     yyyy, mm, dd = value.split('-')
     return datetime(year=int(yyyy), month=int(mm), day=int(dd))
@@ -549,18 +719,16 @@ class UpdateFromYouTube(HTTPEndpoint):
         channel_id = request.query_params.get("channel_id")
         if channel_id:
             channels = [Channel.get(id=channel_id)]
-            first_page_only = False
         else:
             channels = list(Channel.select())
             # prioritize your favorite channels
             channels.sort(key=lambda c: c.local_view_count, reverse=True)
-            first_page_only = True
-        downloaded_ytids = set(p.stem for p in get_all_downloaded_paths())
+        downloaded_ytids = file_index.downloaded.ytids()
         return StreamingResponse(
             wrapper_for_fetch_generator(
                 channels,
                 downloaded_ytids,
-                first_page_only=first_page_only,
+                force_full_sync=bool(request.query_params.get("full")),
             ),
             media_type="text/html",
         )
@@ -568,25 +736,20 @@ class UpdateFromYouTube(HTTPEndpoint):
 
 class RecentlyPublished(HTTPEndpoint):
     def get(self, request: Request):
-        downloaded_ytids = set(p.stem for p in get_all_downloaded_paths())
-        preview_ytids = set(p.stem for p in get_all_preview_paths())
+        downloaded_ytids = file_index.downloaded.ytids()
+        preview_ytids = file_index.previews.ytids()
 
         ignore_terms = IgnoreTerm.all_terms()
 
-        videos = (Video.select().order_by(Video.published_at.desc()))[:300]
+        videos = with_channels(Video.select()).order_by(Video.published_at.desc())[:300]
 
-        htmls = []
-        for video in videos:
-            html = mk_video_html(
-                video,
-                downloaded_ytids=downloaded_ytids,
-                show_static_thumbnails=get_show_static_thumbnails(request),
-                ignore_terms=ignore_terms,
-                show_channel=True,
-                preview_version_ytids=preview_ytids,
-            )
-            if html:
-                htmls.append(html)
+        htmls = VideoCards(
+            downloaded_ytids=downloaded_ytids,
+            show_static_thumbnails=get_show_static_thumbnails(request),
+            ignore_terms=ignore_terms,
+            show_channel=True,
+            preview_version_ytids=preview_ytids,
+        ).render_all(videos)
 
         return render_to_response(
             "RecentlyPublished.html",
@@ -599,31 +762,24 @@ class RecentlyPublished(HTTPEndpoint):
 
 class Downloads(HTTPEndpoint):
     def get(self, request: Request):
-        downloaded_ytids = set(p.stem for p in get_all_downloaded_paths())
-        preview_ytids = set(p.stem for p in get_all_preview_paths())
+        downloaded_ytids = file_index.downloaded.ytids()
+        preview_ytids = file_index.previews.ytids()
 
         ignore_terms = IgnoreTerm.all_terms()
 
         videos = (
-            Video.select()
+            with_channels(Video.select())
             .where(Video.download_status_epoch.is_null(False))
             .order_by(Video.download_status_epoch.desc())
         )[:100]
 
-        htmls = []
-        show_static_thumbnails = get_show_static_thumbnails(request)
-
-        for video in videos:
-            html = mk_video_html(
-                video,
-                downloaded_ytids=downloaded_ytids,
-                ignore_terms=ignore_terms,
-                show_channel=True,
-                show_static_thumbnails=show_static_thumbnails,
-                preview_version_ytids=preview_ytids,
-            )
-            if html:
-                htmls.append(html)
+        htmls = VideoCards(
+            downloaded_ytids=downloaded_ytids,
+            ignore_terms=ignore_terms,
+            show_channel=True,
+            show_static_thumbnails=get_show_static_thumbnails(request),
+            preview_version_ytids=preview_ytids,
+        ).render_all(videos)
 
         return render_to_response(
             "Downloads.html",
@@ -634,112 +790,338 @@ class Downloads(HTTPEndpoint):
         )
 
 
-def mk_video_html(
-    video: Video,
-    *,
-    downloaded_ytids,
-    ignore_terms,
-    show_static_thumbnails,
-    preview_version_ytids,
-    show_channel=False,
-):
-    ytid = video.ytid
-    is_downloaded = ytid in downloaded_ytids
-
-    # put these guards inside the function becuase then we only have to
-    # write this code once, rathen than everywhere this function is called from.
-    if YTIDS_TO_IGNORE and (ytid in YTIDS_TO_IGNORE):
-        return
-    if is_ignorable(video.title, ignore_terms) and (not is_downloaded):
-        return
+class Status(HTTPEndpoint):
+    def get(self, request: Request):
+        today = quota_day()
+        usage = list(
+            QuotaLedger.select()
+            .where(QuotaLedger.day == today)
+            .order_by(QuotaLedger.units.desc())
+        )
+        return render_to_response(
+            "Status.html",
+            dict(
+                BRAND_NAME=BRAND_NAME,
+                today=today,
+                usage=usage,
+                daily_quota=common.API_DAILY_QUOTA,
+                used=QuotaLedger.used_today(),
+                remaining=QuotaLedger.remaining_today(),
+                recent_days=QuotaLedger.recent_days(),
+                requests_per_second=common.API_REQUESTS_PER_SECOND,
+                task_counts=list(
+                    QueuedTask.select(QueuedTask.status, peewee.fn.COUNT(QueuedTask.id))
+                    .group_by(QueuedTask.status)
+                    .tuples()
+                ),
+                dead_tasks=list(
+                    QueuedTask.select()
+                    .where(QueuedTask.status == TASK_STATUS.DEAD)
+                    .order_by(QueuedTask.id.desc())
+                ),
+                thumbnail_packs=common.THUMBNAIL_PACKS,
+                num_packed_thumbnails=len(thumbnail_pack.index.ytids()),
+            ),
+        )
 
-    if not preview_version_ytids:
-        preview_version_ytids = []
-    # if video.is_1080p_or_lower():
-    #     # let's not even waste our time creating an instance, downloading the thumbnail
-    #     # etc. but this is a bit of a gotcha.
-    #     return
-    dt = video.published_at
-    published_at = f"{dt.year}-{dt.month}-{dt.day}"
-    mm, ss = divmod(video.duration, 60)
-    bullets = dict(
-        published_at=published_at,
-        duration=f"{mm}:{ss:02d}",
-    )
-    if video.height:
-        bullets["format"] = f"{video.width}x{video.height} @ {video.fps}"
-
-    title: str = video.title
-
-    if TERMS_TO_HIGHLIGHT:
-        for term in TERMS_TO_HIGHLIGHT:
-            title = title.replace(term, f'<span class="highlight-term">{term}</span>')
-
-    bullets.update(
-        yt_view_count="{:,.0f}".format(round(video.yt_view_count, -3)),
-        views_per_like="?"
-        if video.yt_like_count is None
-        else int(video.views_per_like()),
-        # put title last because it breaks lines
-        title=title,
-    )
 
-    if show_channel:
-        url = app.url_path_for("BrowseChannel", channel_id=video.channel.id)
-        bullets["channel"] = f"""<a href="{url}">{video.channel.name}</a>"""
+class BackfillLocalPreviews(HTTPEndpoint):
+    async def post(self, request: Request):
+        QueuedTask.enqueue('backfill_local_previews', revive_dead=True)
+        wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
 
-    # if is_downloaded:
-    #     video_url = path2url(video.file_path())
-    # else:
-    #     video_url = ''
 
-    if (not show_static_thumbnails) and ytid in preview_version_ytids:
-        preview_url = path2url(video.preview_file_path())
-    else:
-        preview_url = ""
+class DownloadMissingThumbnails(HTTPEndpoint):
+    async def post(self, request: Request):
+        """
+        for all channels at once.
+        better to do it here in main process rather than worker,
+        because this is already async and we sidestep the issue with
+        WindowsSelectorEventLoopPolicy.
+        """
+        ytids_with_thumbnails = (
+            file_index.thumbnails.ytids() | thumbnail_pack.index.ytids()
+        )
+        videos = [
+            (channel_id, ytid)
+            for channel_id, ytid in Video.select(Video.channel, Video.ytid).tuples()
+            if ytid not in ytids_with_thumbnails
+        ]
+        task = BackgroundTask(download_thumbnails, videos)
+        return HTMLResponse(
+            f"Downloading {len(videos)} thumbnails. Wait a bit then reload.",
+            background=task,
+        )
+
+
+class BackfillSmallThumbnails(HTTPEndpoint):
+    async def post(self, request: Request):
+        QueuedTask.enqueue('backfill_small_thumbnails', revive_dead=True)
+        wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
+
+
+class BackfillThumbnailPlaceholders(HTTPEndpoint):
+    async def post(self, request: Request):
+        QueuedTask.enqueue('backfill_thumbnail_placeholders', revive_dead=True)
+        wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
+
+
+class PackThumbnails(HTTPEndpoint):
+    async def post(self, request: Request):
+        QueuedTask.enqueue('pack_thumbnails', revive_dead=True)
+        wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
+
+
+class UnpackThumbnails(HTTPEndpoint):
+    async def post(self, request: Request):
+        QueuedTask.enqueue('unpack_thumbnails', revive_dead=True)
+        wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
+
+
+class ServePackedThumbnail(HTTPEndpoint):
+    def get(self, request: Request):
+        content = thumbnail_pack.read(
+            request.path_params["ytid"], request.path_params["size"]
+        )
+        if content is None:
+            return Response(status_code=404)
+        return media.content_response(content, "image/jpeg", request.scope)
+
+
+class RetryTask(HTTPEndpoint):
+    async def post(self, request: Request):
+        form = await request.form()
+        task = QueuedTask.get_or_none(id=int(form["task_id"]))
+        if task:
+            task.retry()
+            wakeup.notify()
+        return RedirectResponse(app.router.url_path_for("Status"), status_code=303)
+
+
+class VideoCards:
+    """
+    Renders video cards for a whole page.
+    The template and URLs that are the same for every card are resolved once
+    rather than per card, which adds up on a 500-card channel page.
+    """
+
+    def __init__(
+        self,
+        *,
+        downloaded_ytids,
+        ignore_terms,
+        show_static_thumbnails,
+        preview_version_ytids,
+        show_channel=False,
+    ):
+        self.downloaded_ytids = downloaded_ytids
+        self.ignore_terms = ignore_terms
+        self.show_static_thumbnails = show_static_thumbnails
+        self.preview_version_ytids = preview_version_ytids or set()
+        self.show_channel = show_channel
+        self.template = loader("video.html")
+        # this happened for me with a private video.
+        self.missing_thumbnail_url = static("missing-thumbnail.jpg")
+        self._channel_urls = {}
+        self._packed_thumbnail_urls = {
+            size: app.url_path_for("PackedThumbnail", size=size, ytid="YTID")
+            for size in [thumbnail_pack.FULL, thumbnail_pack.SMALL]
+        }
+
+    def channel_url(self, channel_id):
+        if channel_id not in self._channel_urls:
+            self._channel_urls[channel_id] = app.url_path_for(
+                "BrowseChannel", channel_id=channel_id
+            )
+        return self._channel_urls[channel_id]
+
+    def thumbnail_url(self, video: Video):
+        ytid = video.ytid
+        packed_sizes = thumbnail_pack.index.sizes(ytid)
+        # the small one is a fraction of the size, and big enough for a card
+        for size, files in [
+            (thumbnail_pack.SMALL, file_index.small_thumbnails),
+            (thumbnail_pack.FULL, file_index.thumbnails),
+        ]:
+            if size in packed_sizes:
+                url = self._packed_thumbnail_urls[size].replace("YTID", ytid)
+                return f"{url}?{media.VERSION_PARAM}={packed_sizes[size]}"
+            path = files.get(ytid, video.channel_id)
+            if path:
+                return path2url(path, files.version(path))
+        return self.missing_thumbnail_url
+
+    def render_all(self, videos) -> list:
+        htmls = []
+        for video in videos:
+            html = self.render(video)
+            if html:
+                htmls.append(html)
+        return htmls
+
+    def render(self, video: Video):
+        ytid = video.ytid
+        is_downloaded = ytid in self.downloaded_ytids
 
-    if common.FORCE_VERTICAL:
+        # put these guards inside the function becuase then we only have to
+        # write this code once, rathen than everywhere this function is called from.
+        if YTIDS_TO_IGNORE and (ytid in YTIDS_TO_IGNORE):
+            return
+        if is_ignorable(video.title, self.ignore_terms) and (not is_downloaded):
+            return
+
+        # if video.is_1080p_or_lower():
+        #     # let's not even waste our time creating an instance, downloading the thumbnail
+        #     # etc. but this is a bit of a gotcha.
+        #     return
+        dt = video.published_at
+        published_at = f"{dt.year}-{dt.month}-{dt.day}"
+        mm, ss = divmod(video.duration, 60)
+        bullets = dict(
+            published_at=published_at,
+            duration=f"{mm}:{ss:02d}",
+        )
         if video.height:
-            is_portrait = video.height > video.width
-        else:
-            is_portrait = None
-        if is_portrait:
-            download_icon = '▮'
+            bullets["format"] = f"{video.width}x{video.height} @ {video.fps}"
+
+        title: str = video.title
+
+        if TERMS_TO_HIGHLIGHT:
+            for term in TERMS_TO_HIGHLIGHT:
+                title = title.replace(term, f'<span class="highlight-term">{term}</span>')
+
+        bullets.update(
+            yt_view_count="{:,.0f}".format(round(video.yt_view_count, -3)),
+            views_per_like="?"
+            if video.yt_like_count is None
+            else int(video.views_per_like()),
+            # put title last because it breaks lines
+            title=title,
+        )
+
+        if self.show_channel:
+            url = self.channel_url(video.channel_id)
+            bullets["channel"] = f"""<a href="{url}">{video.channel.name}</a>"""
+
+        # if is_downloaded:
+        #     video_url = path2url(video.file_path())
+        # else:
+        #     video_url = ''
+
+        if (not self.show_static_thumbnails) and ytid in self.preview_version_ytids:
+            preview_url = video.preview_url()
         else:
-            download_icon = '▭'
-    else:
-        download_icon = '⭳'
-    thumbnail_path = video.thumbnail_path()
+            preview_url = ""
 
-    if thumbnail_path.exists():
-        thumbnail_url = path2url(thumbnail_path)
-    else:
-        # this happened for me with a private video.
-        thumbnail_url = app.router.url_path_for("static", path="missing-thumbnail.jpg")
-
-    return loader("video.html").render(
-        dict(
-            bullets=bullets,
-            video=video,
-            is_downloaded=is_downloaded,
-            download_icon=download_icon,
-            thumbnail_url=thumbnail_url,
-            # video_url=video_url,
-            preview_url=preview_url,
-        ),
-        strict_mode=True,
-    )
+        if common.FORCE_VERTICAL:
+            if video.height:
+                is_portrait = video.height > video.width
+            else:
+                is_portrait = None
+            if is_portrait:
+                download_icon = '▮'
+            else:
+                download_icon = '▭'
+        else:
+            download_icon = '⭳'
+        return self.template.render(
+            dict(
+                bullets=bullets,
+                video=video,
+                is_downloaded=is_downloaded,
+                download_icon=download_icon,
+                thumbnail_url=self.thumbnail_url(video),
+                # video_url=video_url,
+                preview_url=preview_url,
+            ),
+            strict_mode=True,
+        )
 
 
 def static(path):
-    return app.router.url_path_for("static", path=path)
+    """versioned with the file's mtime, see media.py"""
+    url = app.router.url_path_for("static", path=path)
+    try:
+        _, stat_result = static_app.lookup_path(path)
+    except OSError:
+        stat_result = None
+    if stat_result is None:
+        return url
+    return f"{url}?{media.VERSION_PARAM}={stat_result.st_mtime_ns}"
+
+
+# the fields that mk_video_model_fields sets, which can change on YouTube
+# and so get updated for videos we already have.
+_VIDEO_API_FIELDS = [
+    Video.duration,
+    Video.title,
+    Video.published_at,
+    Video.yt_view_count,
+    Video.yt_like_count,
+]
+
+
+def ingest_page(
+    channel: Channel, page, ignore_terms, known_ytids: Optional[set] = None
+) -> List[Video]:
+    """
+    Saves a page of video resources from the API in one transaction,
+    rather than a commit per video.
+    Returns only the videos that are new.
+    known_ytids is for when the caller already looked up this page's videos.
+
+    we update the stats of videos we already have, but don't show them.
+    that makes it clearer to see what videos are new,
+    without having to mark them somehow.
+    videos getting stats updated is a side effect.
+    you can ensure stats are updated by loading tha channel
+    and waiting for it to complete.
+    """
+    rows = []
+    new_videos = []
+    with db.atomic():
+        if known_ytids is None:
+            # only look up this page's videos, so that memory use doesn't
+            # grow with the size of the library.
+            known_ytids = Video.known_ytids(d1["id"] for d1 in page)
+        for d1 in page:
+            ytid = d1["id"]
+            fields = mk_video_model_fields(d1)
+            # not one of the API fields, so it won't overwrite a placeholder we have
+            fields["thumbnail_placeholder"] = d1.get("thumbnail_placeholder")
+            if ytid not in known_ytids:
+                if is_ignorable(fields["title"], ignore_terms):
+                    continue
+                new_videos.append(Video(**fields, channel=channel, ytid=ytid))
+            rows.append(dict(fields, channel=channel.id, ytid=ytid))
+        if not rows:
+            return new_videos
+        (
+            Video.insert_many(rows)
+            .on_conflict(conflict_target=[Video.ytid], preserve=_VIDEO_API_FIELDS)
+            .execute()
+        )
+        # it might be overkill to download the 1-second previews
+        # for all videos. you might have a huge number of channels/videos,
+        # and those 1-second videos are not useful in all cases.
+        # maybe we should have a button specifically for that.
+        if channel.auto_download_previews:
+            Video.schedule_download_previews(new_videos)
+    if channel.auto_download_previews and new_videos:
+        wakeup.notify()
+    return new_videos
 
 
 def mk_video_model_fields(d1) -> dict:
     return dict(
         duration=convert_iso8601(d1["contentDetails"]["duration"]),
         title=d1["snippet"]["title"],
-        published_at=datetime.fromisoformat(d1["snippet"]["publishedAt"][:-1]),
+        published_at=youtube_api.published_at(d1),
         yt_view_count=int(d1["statistics"]["viewCount"]),
         yt_like_count=int(d1["statistics"].get("likeCount", 0)),
     )
@@ -757,19 +1139,17 @@ class Download(HTTPEndpoint):
         video.set_download_status(DOWNLOAD_STATUS.QUEUED)
         video.save()
 
-        QueuedTask.create(
-            operation='download',
+        QueuedTask.enqueue(
+            'download',
             # downloading should be higher pri because
             # it means you explicitly want that video.
             priority=5,
-            kwargs_json=json.dumps(
-                dict(
-                    ytid=ytid,
-                    channel_dir=str(channel.video_dir()),
-                    preview_channel_dir=str(channel.preview_video_dir()),
-                )
-            ),
+            revive_dead=True,
+            ytid=ytid,
+            channel_dir=str(channel.video_dir()),
+            preview_channel_dir=str(channel.preview_video_dir()),
         )
+        wakeup.notify()
 
         return Response("")
 
@@ -832,6 +1212,8 @@ class WatchMPV(HTTPEndpoint):
             channel = video.channel
             channel.local_view_count += 1
             channel.save()
+            # the most watched videos are the ones previewed on the home page
+            ChannelStats.refresh(channel.id)
             is_landscape = video.width > video.height
             paths = [video.file_path()]
         else:
@@ -900,24 +1282,6 @@ class ChannelAction(HTTPEndpoint):
             return HTMLResponse(
                 f"Downloading most recent {_PREVIEWS_CHUNK_SIZE} previews"
             )
-        if action == "download-missing-thumbnails":
-            # better to do it here in main process rather than worker,
-            # because this is already async and we sidestep the issue with
-            # WindowsSelectorEventLoopPolicy.
-            ytids_with_thumbnails = set(
-                p.stem for p in channel.thumbnail_dir().glob("*.jpg")
-            )
-            ytids = []
-            for v in Video.select(Video.ytid).where(Video.channel == channel):
-                if v.ytid not in ytids_with_thumbnails:
-                    ytids.append(v.ytid)
-                    # get the full object
-            task = BackgroundTask(
-                download_video_thumbnails, channel_id=channel.id, ytids=ytids
-            )
-            return HTMLResponse(
-                "Downloading thumbnails. Wait a bit then reload.", background=task
-            )
 
 
 class DeleteChannel(HTTPEndpoint):
@@ -938,18 +1302,22 @@ _PREVIEWS_CHUNK_SIZE = 50
 
 
 def schedule_download_previews_chunk(channel: Channel):
-    num_scheduled = 0
+    to_schedule = []
+    preview_ytids = file_index.previews.ytids(channel.id)
     for v in channel.videos():
         # part of downloading the preview is also fetching video dims
         # which is necessary for displaying the preview properly.
         # the user might delete the channel from the DB but keep the preview viedos
         # so we must re-download the stats.
-        if not (v.preview_file_path().exists() and v.height):
-            v.schedule_download_preview()
-            num_scheduled += 1
+        if not (v.ytid in preview_ytids and v.height):
+            to_schedule.append(v)
         # each time you toggle it, download another chunk
-        if num_scheduled > _PREVIEWS_CHUNK_SIZE:
-            return
+        if len(to_schedule) > _PREVIEWS_CHUNK_SIZE:
+            break
+    if to_schedule:
+        # one batch task for all of them
+        Video.schedule_download_previews(to_schedule)
+        wakeup.notify()
 
 
 class ToggleAutoDownloadPreview(HTTPEndpoint):
@@ -967,6 +1335,9 @@ class ToggleAutoDownloadPreview(HTTPEndpoint):
 
 SHOW_STATIC_THUMBNAILS_COOKIE = "show_static_thumbnails"
 SEARCH_ORDER_BY_DATE_COOKIE = "search_order_by_date"
+# the cookie predates this option, so it keeps its name;
+# "1" is date, "0" is likes.
+SEARCH_ORDER_BY_RELEVANCE = "rank"
 
 
 def get_show_static_thumbnails(request: Request):
@@ -987,9 +1358,19 @@ class ToggleShowStaticThumbnails(HTTPEndpoint):
         return response
 
 
-static_app = StaticFiles(directory=FILES_ROOT, packages=[__name__])
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    ApiCache.prune()
+    full_syncs = asyncio.create_task(full_sync_loop())
+    yield
+    full_syncs.cancel()
+    await youtube_api.close_session()
+
+
+static_app = media.MediaFiles(directory=FILES_ROOT, packages=[__name__])
 app = Starlette(
     debug=True,
+    lifespan=lifespan,
     routes=[
         Route("/", Index, name="Index"),
         Route("/channel/{channel_id}", BrowseChannel, name="BrowseChannel"),
@@ -997,6 +1378,19 @@ app = Starlette(
         Route("/UpdateFromYouTube", UpdateFromYouTube, name="UpdateFromYouTube"),
         Route("/RecentlyPublished", RecentlyPublished, name="RecentlyPublished"),
         Route("/Downloads", Downloads, name="Downloads"),
+        Route("/status", Status, name="Status"),
+        Route("/retry-task", RetryTask),
+        Route("/download-missing-thumbnails", DownloadMissingThumbnails),
+        Route("/backfill-local-previews", BackfillLocalPreviews),
+        Route("/backfill-small-thumbnails", BackfillSmallThumbnails),
+        Route("/backfill-thumbnail-placeholders", BackfillThumbnailPlaceholders),
+        Route("/pack-thumbnails", PackThumbnails),
+        Route("/unpack-thumbnails", UnpackThumbnails),
+        Route(
+            "/packed-thumbnails/{size}/{ytid}.jpg",
+            ServePackedThumbnail,
+            name="PackedThumbnail",
+        ),
         Route("/AddChannel", AddChannel, name="AddChannel"),
         Route("/download", Download),
         Route("/ignore_terms", ModifyIgnoreTerms),
@@ -1087,7 +1481,21 @@ def main():
         sys.exit(0)
 
     common.startup_checks()
-    db.create_tables([Channel, Video, IgnoreTerm, QueuedTask])
+    db.create_tables(
+        [
+            Channel,
+            Video,
+            IgnoreTerm,
+            QueuedTask,
+            VideoSearch,
+            ChannelStats,
+            ApiCache,
+            QuotaLedger,
+            RateLimiter,
+            PackedThumbnail,
+        ]
+    )
+    create_search_triggers()
 
     if cmd == SUBCOMMANDS.WORKER:
         from .tasks import listen
@@ -1,11 +1,17 @@
 import asyncio
 import atexit
+import base64
+import json
+import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
+import time
 from pathlib import Path
+from typing import Optional
 
 import aiohttp
 import toml
@@ -13,6 +19,8 @@ import yt_dlp
 from aiohttp import ClientSession
 from icecream import ic  # noqa
 
+from .ytdl_service import YtdlService
+
 print_function = print
 
 FILES_ROOT = Path('.')
@@ -22,10 +30,27 @@ CMD_NAME = BRAND_NAME.lower()
 
 VIDEOS_ROOT = FILES_ROOT.joinpath('videos')
 THUMBNAILS_ROOT = FILES_ROOT.joinpath('thumbnails')
+# card-sized copies of the thumbnails, since the originals are up to 1280x720
+SMALL_THUMBNAILS_ROOT = FILES_ROOT.joinpath('thumbnails_small')
+SMALL_THUMBNAIL_WIDTH = 320
+# a tiny version of each thumbnail goes right into the page
+# (see Video.thumbnail_placeholder), so that cards show something
+# before the real thumbnails load.
+# at this width (8x4) it's a PNG of about 170 bytes, 220 as base64,
+# which the browser scales up blurry.
+PLACEHOLDER_WIDTH = 8
+# see thumbnail_pack
+THUMBNAIL_PACKS_ROOT = FILES_ROOT.joinpath('thumbnail_packs')
 CHANNEL_THUMBNAILS_DIR = FILES_ROOT.joinpath('channel_thumbnails')
 
 PREVIEW_ROOT = FILES_ROOT.joinpath('preview_videos')
 PREVIEW_SHORT_ROOT = FILES_ROOT.joinpath('preview_videos_shorter')
+# yt-dlp's info about videos that are being downloaded
+VIDEO_INFO_DIR = FILES_ROOT.joinpath('video_info')
+# the format URLs in the info expire after about 6 hours
+VIDEO_INFO_MAX_AGE = 5 * 60 * 60
+
+VIDEO_FILE_EXTENSIONS = ['webm', 'mp4', 'mkv', 'avi']
 
 # call it this so it doesn't get confused with some other settings.json
 # and easier to search for and more distinctive.
@@ -54,6 +79,16 @@ class _PREFKEYS:
     PORT = 'port'
     RECENT_DAYS = 'recent_days'
     LAUNCH_BROWSER = 'launch_browser'
+    REFRESH_CONCURRENCY = 'refresh_concurrency'
+    FULL_SYNC_DAYS = 'full_sync_days'
+    API_CACHE_TTLS = 'api_cache_ttls'
+    API_DAILY_QUOTA = 'api_daily_quota'
+    API_REQUESTS_PER_SECOND = 'api_requests_per_second'
+    WORKER_PORT = 'worker_port'
+    WORKER_CONCURRENCY = 'worker_concurrency'
+    PREVIEW_BATCH_CONCURRENCY = 'preview_batch_concurrency'
+    PREVIEW_ENCODE_PROCESSES = 'preview_encode_processes'
+    THUMBNAIL_PACKS = 'thumbnail_packs'
 
 
 DEFAULT_PORT = 8500
@@ -69,6 +104,9 @@ _INITIAL_PREFS_CONTENT = {
 LAUNCH_BROWSER = _prefs.get(_PREFKEYS.LAUNCH_BROWSER, True)
 YOUTUBE_API_KEY = _prefs.get(_PREFKEYS.YOUTUBE_API_KEY)
 YT_DLP_CMD = _prefs.get(_PREFKEYS.YT_DLP_EXECUTABLE) or 'yt-dlp'
+# if you chose a specific yt-dlp executable, we download with that.
+# otherwise we use the yt_dlp package that we already import (see ytdl_service).
+YT_DLP_IN_PROCESS = not _prefs.get(_PREFKEYS.YT_DLP_EXECUTABLE)
 YT_DLP_FLAGS = _prefs.get(_PREFKEYS.YT_DLP_FLAGS, '')
 VIDEO_PLAYER_CMD = (
     _prefs.get(_PREFKEYS.VIDEO_PLAYER_EXECUTABLE)
@@ -88,7 +126,78 @@ else:
 
 FORCE_VERTICAL = _prefs.get(_PREFKEYS.FORCE_VERTICAL)
 PORT = _prefs.get(_PREFKEYS.PORT, DEFAULT_PORT)
+# UDP port on localhost that the web process uses to wake up the worker
+WORKER_PORT = _prefs.get(_PREFKEYS.WORKER_PORT, PORT + 1)
 RECENT_DAYS = _prefs.get(_PREFKEYS.RECENT_DAYS, 30)
+# how many channels to fetch from YouTube at the same time when updating
+REFRESH_CONCURRENCY = _prefs.get(_PREFKEYS.REFRESH_CONCURRENCY, 8)
+# otherwise updates only fetch the videos that are newer than last time.
+# 0 (the default) means the server never connects to YouTube on its own,
+# so full syncs only happen when you click the channel page's button.
+FULL_SYNC_DAYS = _prefs.get(_PREFKEYS.FULL_SYNC_DAYS, 0)
+
+# seconds that a cached YouTube API response is used without asking YouTube at all.
+# after that, it's revalidated with its ETag.
+# playlistItems is 0 because that's how we find new uploads.
+# can be overridden per resource in settings.toml, e.g.:
+# [api_cache_ttls]
+# videos = 0
+API_CACHE_TTLS = dict(
+    channels=24 * 60 * 60,
+    playlistItems=0,
+    videos=60 * 60,
+)
+API_CACHE_TTLS.update(_prefs.get(_PREFKEYS.API_CACHE_TTLS, {}))
+
+# the default quota for a YouTube Data API project
+API_DAILY_QUOTA = _prefs.get(_PREFKEYS.API_DAILY_QUOTA, 10_000)
+API_REQUESTS_PER_SECOND = _prefs.get(_PREFKEYS.API_REQUESTS_PER_SECOND, 5)
+
+# how many tasks of each kind the worker runs at the same time.
+# previews are fetched in batches, see PREVIEW_BATCH_CONCURRENCY.
+# can be overridden in settings.toml, e.g.:
+# [worker_concurrency]
+# download = 1
+WORKER_CONCURRENCY = dict(
+    download=2,
+    # new previews are always queued as download_previews batches.
+    # one slot is enough to finish the single ones queued before that.
+    download_preview=1,
+    download_previews=1,
+    backfill_local_previews=1,
+    backfill_small_thumbnails=1,
+    pack_thumbnails=1,
+    unpack_thumbnails=1,
+    backfill_thumbnail_placeholders=1,
+)
+WORKER_CONCURRENCY.update(_prefs.get(_PREFKEYS.WORKER_CONCURRENCY, {}))
+# how many previews a download_previews batch fetches at the same time
+PREVIEW_BATCH_CONCURRENCY = _prefs.get(_PREFKEYS.PREVIEW_BATCH_CONCURRENCY, 4)
+
+# for making previews from downloaded videos with ffmpeg,
+# see tasks.backfill_local_previews.
+# leave some cores for the web server and whatever else you're doing.
+PREVIEW_ENCODE_PROCESSES = _prefs.get(
+    _PREFKEYS.PREVIEW_ENCODE_PROCESSES, max((os.cpu_count() or 2) // 2, 1)
+)
+# added to the encoding processes' niceness, so they don't make the computer sluggish
+PREVIEW_ENCODE_NICENESS = 10
+
+# store new video thumbnails in one pack file per channel
+# instead of a file per video, see thumbnail_pack.
+THUMBNAIL_PACKS = _prefs.get(_PREFKEYS.THUMBNAIL_PACKS, False)
+
+FFMPEG_CMD = 'ffmpeg'
+FFPROBE_CMD = 'ffprobe'
+
+# one thread per video that the worker can be working on,
+# so that a slot never waits for another slot's job.
+YTDL = YtdlService(
+    num_threads=WORKER_CONCURRENCY['download']
+    + WORKER_CONCURRENCY['download_preview']
+    + WORKER_CONCURRENCY['download_previews'] * PREVIEW_BATCH_CONCURRENCY,
+    flags=YT_DLP_FLAGS,
+)
 
 
 _ytids_to_ignore_file = Path('ytids_to_ignore.txt')
@@ -136,6 +245,7 @@ def create_library():
 
     VIDEOS_ROOT.mkdir(exist_ok=True)
     THUMBNAILS_ROOT.mkdir(exist_ok=True)
+    SMALL_THUMBNAILS_ROOT.mkdir(exist_ok=True)
     CHANNEL_THUMBNAILS_DIR.mkdir(exist_ok=True)
     PREVIEW_ROOT.mkdir(exist_ok=True)
     PREVIEW_SHORT_ROOT.mkdir(exist_ok=True)
@@ -178,7 +288,6 @@ def call(*segments, capture_output=False):
     cmd_str = ' '.join(str(arg) for arg in segments)
     print_function(cmd_str)
     # cmd = cmd_str.split()
-    import shlex
 
     # use shlex.split so that it is smart about quoted things like
     # filenames and ffmpeg -vf filter
@@ -192,24 +301,84 @@ def call(*segments, capture_output=False):
         raise
 
 
-def path2url(path: Path):
-    assert path.exists()
+def path2url(path: Path, version=None):
+    """
+    version is something that changes whenever the file does, e.g. its mtime.
+    then the browser can cache the URL for good, see media.MediaFiles.
+    """
+    # no exists() check, because this gets called for every card on a page.
+    # callers get the path from file_index.
     relpath = path.relative_to(FILES_ROOT).as_posix()
-    return f'/static/{relpath}'
+    url = f'/static/{relpath}'
+    if version is not None:
+        url += f'?v={version}'
+    return url
+
+
+def video_info_path(ytid) -> Path:
+    return VIDEO_INFO_DIR.joinpath(f'{ytid}.info.json')
+
+
+def cached_video_info_path(ytid) -> Optional[Path]:
+    """
+    the info has the URLs of the video's formats, which expire,
+    so it's only useful for a few hours.
+    """
+    path = video_info_path(ytid)
+    try:
+        age = time.time() - path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+    if age < VIDEO_INFO_MAX_AGE:
+        return path
 
 
-def download_video_file_info(ytid):
+def extract_video_info(ytid) -> Optional[Path]:
+    """
+    saves yt-dlp's info for the video, so that yt-dlp can then download from it
+    with --load-info-json, instead of fetching and parsing the watch page again.
+    """
+    path = cached_video_info_path(ytid)
+    if path:
+        return path
     watch_url = f'https://www.youtube.com/watch?v={ytid}'
-    with yt_dlp.YoutubeDL({}) as ydl:
+    try:
+        if YT_DLP_IN_PROCESS:
+            info_json = json.dumps(YTDL.extract_info(watch_url))
+        else:
+            # -J prints the same sanitized info that extract_info returns
+            proc = call(
+                YT_DLP_CMD, YT_DLP_FLAGS, '-J', watch_url, capture_output=True
+            )
+            info_json = proc.stdout.decode('utf8')
+    except (yt_dlp.utils.DownloadError, subprocess.CalledProcessError):
+        print_function('Download error', watch_url)
+        return
+    path = video_info_path(ytid)
+    VIDEO_INFO_DIR.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(info_json, encoding='utf8')
+    tmp_path.replace(path)
+    return path
+
+
+def prune_video_info():
+    if not VIDEO_INFO_DIR.exists():
+        return
+    for path in VIDEO_INFO_DIR.iterdir():
         try:
-            d2 = ydl.extract_info(watch_url, download=False)
-        except yt_dlp.utils.DownloadError:
-            print_function('Download error', watch_url)
-            return
+            if time.time() - path.stat().st_mtime > VIDEO_INFO_MAX_AGE:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def get_format_stats(info_path: Path) -> dict:
+    info = json.loads(info_path.read_text(encoding='utf8'))
 
     format_keys = ['width', 'height', 'fps', 'format_id']
 
-    format = {k: d2['formats'][-1][k] for k in format_keys}
+    format = {k: info['formats'][-1][k] for k in format_keys}
     width = int(format['width'])
     height = int(format['height'])
 
@@ -220,44 +389,151 @@ def download_video_file_info(ytid):
     )
 
 
-async def download_video_thumbnail(ytid, outpath: Path, session: ClientSession):
+def probe_video(path: Path) -> dict:
+    """the same format stats as get_format_stats, plus the duration, from ffprobe"""
+    result = subprocess.run(
+        [
+            FFPROBE_CMD,
+            '-v',
+            'error',
+            '-select_streams',
+            'v:0',
+            '-show_entries',
+            'stream=width,height,avg_frame_rate:format=duration',
+            '-of',
+            'json',
+            str(path),
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    probe = json.loads(result.stdout)
+    [stream] = probe['streams']
+    numerator, _, denominator = stream['avg_frame_rate'].partition('/')
+    fps = int(numerator) / int(denominator or 1) if int(denominator or 1) else 0
+    return dict(
+        width=int(stream['width']),
+        height=int(stream['height']),
+        fps=round(fps),
+        duration=float(probe['format'].get('duration', 0)),
+    )
+
+
+def cut_preview(inp: Path, outp: Path, ss=5, to=25):
+    """
+    makes a preview clip like the ones we download from YouTube:
+    no audio, and 360 pixels on the short side.
+    -ss goes before -i so that ffmpeg jumps to the nearest keyframe
+    instead of decoding everything before it.
+    """
+    # don't rotate because we want to be consistent with preview-version videos
+    # downloaded from youtube. the rotating happens in HTML.
+    scale = "scale='if(gt(iw,ih),-2,360)':'if(gt(iw,ih),360,-2)'"
+    call(
+        FFMPEG_CMD,
+        '-hide_banner -loglevel error',
+        f'-ss {ss} -t {to - ss}',
+        '-i',
+        shlex.quote(inp.as_posix()),
+        f'-an -vf "{scale}" -c:v libx264 -preset veryfast -crf 28',
+        '-movflags +faststart -y',
+        shlex.quote(outp.as_posix()),
+    )
+
+
+# best first. not every video has the bigger ones.
+THUMBNAIL_VERSIONS = ['maxresdefault', 'sddefault', 'hqdefault']
+# connections to i.ytimg.com at the same time
+THUMBNAIL_CONNECTIONS = 8
+# if a version is missing, YouTube might still send its gray placeholder,
+# which is a 120x90 image of about 1KB.
+MIN_THUMBNAIL_BYTES = 2000
+
+
+def write_file(path: Path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # so that a half-written file never shows up in the index
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_bytes(content)
+    tmp_path.replace(path)
+
+
+async def download_video_thumbnail(
+    ytid, channel_id, session: ClientSession, semaphore: asyncio.Semaphore
+) -> Optional[str]:
     """
     I think we need thumbnails no matter what....for example to show
     the channel thumbnail.
+    returns the thumbnail's placeholder, or None if it couldn't get one.
     """
-    image_versions = ['maxresdefault', 'hqdefault', 'hqdefault']
-    for version in image_versions:
+    for version in THUMBNAIL_VERSIONS:
         url = f'https://i.ytimg.com/vi/{ytid}/{version}.jpg'
         try:
-            async with session.get(url, timeout=10) as response:
-                content = await response.read()
-                outpath.write_bytes(content)
-                return
-        except (aiohttp.ServerDisconnectedError, asyncio.TimeoutError) as exc:
+            async with semaphore:
+                async with session.get(url) as response:
+                    if response.status != 200:
+                        continue
+                    content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             print_function(exc)
             print_function(f"Couldn't download thumbnail for {ytid}, skipping")
-            return
+            return None
+        # JPEGs start with FF D8
+        if len(content) < MIN_THUMBNAIL_BYTES or not content.startswith(b'\xff\xd8'):
+            continue
+        # don't block the event loop, especially if the library is on a slow drive
+        return await asyncio.to_thread(save_thumbnail, channel_id, ytid, content)
+    print_function(f"No thumbnail found for {ytid}")
+    return None
 
-        # except aiohttp.
-        # except urllib.error.HTTPError:
-        #     # if maxresdefault is missing it will just be a small
-        #     # gray placeholder that is 1kb
-        #     # and the status code will be 404
-        #     pass
 
+async def download_thumbnails(videos):
+    """
+    videos is a list of (channel_id, ytid), from any number of channels.
+    returns {ytid: placeholder} for the thumbnails it downloaded,
+    and saves the placeholders of videos that are already in the DB.
+    """
+    from . import thumbnail_pack
+
+    packed_ytids = thumbnail_pack.index.ytids()
+    videos = [
+        (channel_id, ytid)
+        for channel_id, ytid in videos
+        if ytid not in packed_ytids
+        and not thumbnail_path(channel_thumbnail_dir(channel_id), ytid).exists()
+    ]
+    if not videos:
+        return {}
+    semaphore = asyncio.Semaphore(THUMBNAIL_CONNECTIONS)
+    async with ClientSession(
+        connector=aiohttp.TCPConnector(limit=THUMBNAIL_CONNECTIONS),
+        timeout=aiohttp.ClientTimeout(total=30, connect=10),
+    ) as session:
+        results = await asyncio.gather(
+            *[
+                download_video_thumbnail(ytid, channel_id, session, semaphore)
+                for channel_id, ytid in videos
+            ]
+        )
 
-async def download_video_thumbnails(channel_id, ytids: list):
-    tasks = []
+    from . import file_index
+    from .models import Video
 
-    folder = channel_thumbnail_dir(channel_id)
-    async with ClientSession() as session:
-        for ytid in ytids:
-            outpath = thumbnail_path(folder, ytid)
-            if not outpath.exists():
-                task = download_video_thumbnail(ytid, outpath, session)
-                tasks.append(task)
+    for channel_id in set(channel_id for channel_id, ytid in videos):
+        file_index.thumbnails.invalidate(channel_thumbnail_dir(channel_id))
+        file_index.small_thumbnails.invalidate(small_thumbnail_dir(channel_id))
+    placeholders = {
+        ytid: placeholder
+        for (channel_id, ytid), placeholder in zip(videos, results)
+        if placeholder
+    }
+    await asyncio.to_thread(Video.set_thumbnail_placeholders, placeholders)
+    return placeholders
 
-        _ = await asyncio.gather(*tasks)
+
+async def download_video_thumbnails(channel_id, ytids: list):
+    return await download_thumbnails([(channel_id, ytid) for ytid in ytids])
 
 
 def channel_thumbnail_dir(channel_id):
@@ -268,6 +544,97 @@ def thumbnail_path(channel_dir: Path, ytid):
     return channel_dir.joinpath(f'{ytid}.jpg')
 
 
+def small_thumbnail_dir(channel_id):
+    return SMALL_THUMBNAILS_ROOT.joinpath(channel_id)
+
+
+def save_thumbnail(channel_id, ytid, content: bytes) -> Optional[str]:
+    """
+    saves a downloaded thumbnail, along with its small version.
+    returns its placeholder.
+    """
+    if THUMBNAIL_PACKS:
+        from . import thumbnail_pack
+
+        thumbnails = [(ytid, thumbnail_pack.FULL, content)]
+        small = small_thumbnail_bytes(content)
+        if small:
+            thumbnails.append((ytid, thumbnail_pack.SMALL, small))
+        thumbnail_pack.add_many(channel_id, thumbnails)
+    else:
+        path = thumbnail_path(channel_thumbnail_dir(channel_id), ytid)
+        write_file(path, content)
+        make_small_thumbnail(path)
+    return thumbnail_placeholder(content)
+
+
+def _convert_thumbnail(content: bytes, scale, output_args) -> Optional[bytes]:
+    """content is a JPEG. returns None if there's no ffmpeg, or it failed."""
+    try:
+        proc = subprocess.run(
+            [FFMPEG_CMD, '-v', 'error', '-f', 'jpeg_pipe', '-i', 'pipe:0']
+            + ['-vf', f'scale={scale}']
+            + output_args
+            + ['-f', 'image2pipe', 'pipe:1'],
+            input=content,
+            capture_output=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as exc:
+        print_function(f"Couldn't convert a thumbnail: {exc!r}")
+        return None
+    return proc.stdout or None
+
+
+def small_thumbnail_bytes(content: bytes) -> Optional[bytes]:
+    """
+    content is the full-size JPEG.
+    if there's no ffmpeg, the cards just use the full-size one.
+    """
+    return _convert_thumbnail(
+        content, f'{SMALL_THUMBNAIL_WIDTH}:-2', ['-q:v', '5', '-c:v', 'mjpeg']
+    )
+
+
+def thumbnail_placeholder(content: bytes) -> Optional[str]:
+    """the base64 of a tiny PNG, for a data: URL"""
+    # area averages the pixels, rather than picking a few of them
+    png = _convert_thumbnail(
+        content,
+        f'{PLACEHOLDER_WIDTH}:-1:flags=area',
+        ['-c:v', 'png', '-compression_level', '9'],
+    )
+    if png:
+        return base64.b64encode(png).decode('ascii')
+
+
+def make_small_thumbnail(path: Path) -> bool:
+    """path is the full-size thumbnail"""
+    try:
+        small = small_thumbnail_bytes(path.read_bytes())
+    except OSError as exc:
+        print_function(f"Couldn't read {path}: {exc!r}")
+        return False
+    if small is None:
+        return False
+    write_file(small_thumbnail_dir(path.parent.name).joinpath(path.name), small)
+    return True
+
+
+_ISO8601_DURATION_REGEX = re.compile(
+    r"P"  # designates a period
+    r"(?:(?P<years>\d+)Y)?"  # years
+    r"(?:(?P<months>\d+)M)?"  # months
+    r"(?:(?P<weeks>\d+)W)?"  # weeks
+    r"(?:(?P<days>\d+)D)?"  # days
+    r"(?:T"  # time part must begin with a T
+    r"(?:(?P<hours>\d+)H)?"  # hours
+    r"(?:(?P<minutes>\d+)M)?"  # minutes
+    r"(?:(?P<seconds>\d+)S)?"  # seconds
+    r")?"
+)  # end of time part
+
+
 def convert_iso8601(s):
     """
     Converts YouTube duration (ISO 8061)
@@ -275,19 +642,7 @@ def convert_iso8601(s):
 
     see http://en.wikipedia.org/wiki/ISO_8601#Durations
     """
-    regex = re.compile(
-        "P"  # designates a period
-        "(?:(?P<years>\d+)Y)?"  # years
-        "(?:(?P<months>\d+)M)?"  # months
-        "(?:(?P<weeks>\d+)W)?"  # weeks
-        "(?:(?P<days>\d+)D)?"  # days
-        "(?:T"  # time part must begin with a T
-        "(?:(?P<hours>\d+)H)?"  # hours
-        "(?:(?P<minutes>\d+)M)?"  # minutes
-        "(?:(?P<seconds>\d+)S)?"  # seconds
-        ")?"
-    )  # end of time part
     # Convert regex matches into a short list of time units
-    units = regex.match(s).groups()[-3:]
+    units = _ISO8601_DURATION_REGEX.match(s).groups()[-3:]
     hours, minutes, seconds = [int(x) if x != None else 0 for x in units]
     return 3600 * hours + 60 * minutes + seconds
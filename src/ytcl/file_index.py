@@ -0,0 +1,200 @@
+"""
+In-memory index of which videos have files on disk
+(downloaded videos, preview clips, thumbnails),
+so that pages don't have to glob the whole library on every request.
+
+Files are laid out as <root>/<channel_id>/<ytid>.<ext>.
+Each channel folder is scanned once with os.scandir and then only re-scanned
+when its mtime changes, which happens whenever a file is added to or removed from it.
+That way we also notice files written by the worker process,
+or videos that the user drops into the folder by hand.
+Code that derives something from the files (e.g. models.ChannelStats)
+can subscribe with on_change() to hear which channels changed.
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from .common import (
+    VIDEOS_ROOT,
+    PREVIEW_ROOT,
+    PREVIEW_SHORT_ROOT,
+    THUMBNAILS_ROOT,
+    SMALL_THUMBNAILS_ROOT,
+    VIDEO_FILE_EXTENSIONS,
+)
+
+# don't stat all the channel folders more than once per this many seconds,
+# since a single page load asks the index several times.
+CHECK_INTERVAL = 1.0
+
+# some filesystems (e.g. FAT on flash drives) only have 2-second mtime resolution,
+# so a file added right after a scan might not change the folder's mtime.
+# don't trust a listing until its folder is older than this.
+MTIME_RESOLUTION = 2.0
+
+
+class _Folder:
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime = None
+        self.files: Dict[str, Path] = {}
+        # stem -> mtime, filled in as they're asked for
+        self.versions: Dict[str, int] = {}
+        self.scanned = False
+
+    def refresh(self, extensions) -> bool:
+        """returns True if the set of files changed"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            changed = bool(self.files)
+            self.mtime = None
+            self.files = {}
+            return changed
+        if mtime == self.mtime:
+            return False
+        changed = not self.scanned
+        self.scanned = True
+        # a file might have been replaced, which also changes the folder's mtime
+        self.versions = {}
+        files = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                stem, _, ext = entry.name.rpartition('.')
+                if stem and ext in extensions and entry.is_file():
+                    files[stem] = Path(entry.path)
+        if files.keys() != self.files.keys():
+            changed = True
+        self.files = files
+        if time.time() - mtime > MTIME_RESOLUTION:
+            self.mtime = mtime
+        else:
+            self.mtime = None
+        return changed
+
+
+class FileIndex:
+    def __init__(self, roots, extensions):
+        # if the same ytid is in several roots, the first root wins.
+        self.roots = [Path(root) for root in roots]
+        self.extensions = set(extensions)
+        # root -> channel_id -> folder
+        self._folders: Dict[Path, Dict[str, _Folder]] = {root: {} for root in self.roots}
+        self._root_mtimes = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def on_change(self, fxn):
+        """fxn gets called with a set of channel IDs whose files changed"""
+        self._listeners.append(fxn)
+
+    def refresh(self):
+        changed_channel_ids = set()
+        with self._lock:
+            if time.time() - self._checked_at < CHECK_INTERVAL:
+                return
+            for root in self.roots:
+                folders = self._folders[root]
+                try:
+                    root_mtime = os.stat(root).st_mtime
+                except FileNotFoundError:
+                    folders.clear()
+                    continue
+                # a channel folder was added or removed
+                if root_mtime != self._root_mtimes.get(root):
+                    channel_ids = set()
+                    with os.scandir(root) as entries:
+                        for entry in entries:
+                            if entry.is_dir():
+                                channel_ids.add(entry.name)
+                    for channel_id in channel_ids - set(folders):
+                        folders[channel_id] = _Folder(root.joinpath(channel_id))
+                    for channel_id in set(folders) - channel_ids:
+                        if folders[channel_id].files:
+                            changed_channel_ids.add(channel_id)
+                        del folders[channel_id]
+                    # same as for the channel folders, see _Folder.refresh
+                    if time.time() - root_mtime > MTIME_RESOLUTION:
+                        self._root_mtimes[root] = root_mtime
+                    else:
+                        self._root_mtimes.pop(root, None)
+                for channel_id, folder in folders.items():
+                    if folder.refresh(self.extensions):
+                        changed_channel_ids.add(channel_id)
+            self._checked_at = time.time()
+        # call these outside the lock, because they will probably read the index.
+        if changed_channel_ids:
+            for fxn in self._listeners:
+                fxn(changed_channel_ids)
+
+    def paths(self, channel_id=None) -> Dict[str, Path]:
+        """ytid -> path"""
+        self.refresh()
+        paths = {}
+        for root in reversed(self.roots):
+            folders = self._folders[root]
+            if channel_id is None:
+                for folder in folders.values():
+                    paths.update(folder.files)
+            elif channel_id in folders:
+                paths.update(folders[channel_id].files)
+        return paths
+
+    def ytids(self, channel_id=None) -> set:
+        return set(self.paths(channel_id))
+
+    def get(self, ytid, channel_id=None) -> Optional[Path]:
+        if channel_id is None:
+            return self.paths().get(ytid)
+        # called once per video card, so avoid building a dict
+        self.refresh()
+        for root in self.roots:
+            folder = self._folders[root].get(channel_id)
+            if folder and ytid in folder.files:
+                return folder.files[ytid]
+
+    def version(self, path: Path) -> Optional[int]:
+        """
+        the file's mtime, for common.path2url.
+        it's looked up the first time it's asked for rather than when scanning,
+        since most files are never shown.
+        """
+        folder = self._folders.get(path.parent.parent, {}).get(path.parent.name)
+        if folder is not None and path.stem in folder.versions:
+            return folder.versions[path.stem]
+        try:
+            version = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if folder is not None:
+            folder.versions[path.stem] = version
+        return version
+
+    def invalidate(self, folder: Path = None):
+        """
+        for when we know something changed in the folder but not the filename,
+        e.g. after yt-dlp picks the extension.
+        """
+        with self._lock:
+            self._checked_at = 0
+            if folder is None:
+                self._root_mtimes.clear()
+                for folders in self._folders.values():
+                    for f in folders.values():
+                        f.mtime = None
+                return
+            folder = Path(folder)
+            folders = self._folders.get(folder.parent)
+            if folders is not None and folder.name in folders:
+                folders[folder.name].mtime = None
+
+
+downloaded = FileIndex([VIDEOS_ROOT], VIDEO_FILE_EXTENSIONS)
+previews = FileIndex([PREVIEW_ROOT, PREVIEW_SHORT_ROOT], VIDEO_FILE_EXTENSIONS)
+thumbnails = FileIndex([THUMBNAILS_ROOT], ['jpg'])
+small_thumbnails = FileIndex([SMALL_THUMBNAILS_ROOT], ['jpg'])
@@ -0,0 +1,62 @@
+"""
+Serves everything under /static: thumbnails, channel thumbnails, preview clips,
+and the statics that come with the package.
+
+Pages link to these with a ?v=<version> that changes whenever the file does
+(see common.path2url and static() in __init__),
+so a versioned URL always means the same bytes, and the browser can keep it
+without asking again. A re-downloaded thumbnail gets a new URL.
+Unversioned URLs are revalidated with their ETag, so a revisit gets a 304
+instead of the whole file.
+
+Starlette's FileResponse already sends a strong ETag and handles Range requests,
+which the preview <video> elements use when seeking.
+"""
+
+import hashlib
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+VERSION_PARAM = 'v'
+
+# a year is the most that's meaningful
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# not "don't cache", but "check the ETag before using the cached copy"
+REVALIDATE = 'no-cache'
+
+
+def cache_control(scope: Scope) -> str:
+    if VERSION_PARAM in QueryParams(scope['query_string']):
+        return IMMUTABLE
+    return REVALIDATE
+
+
+class MediaFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope: Scope, status_code=200):
+        response = FileResponse(
+            full_path, status_code=status_code, stat_result=stat_result
+        )
+        # before the 304 check, since a 304 should have it too
+        response.headers['cache-control'] = cache_control(scope)
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def content_response(content: bytes, media_type, scope: Scope) -> Response:
+    """
+    the same caching as MediaFiles, for media that isn't a file of its own,
+    e.g. packed thumbnails.
+    """
+    etag = f'"{hashlib.md5(content, usedforsecurity=False).hexdigest()}"'
+    headers = {'etag': etag, 'cache-control': cache_control(scope)}
+    if_none_match = Headers(scope=scope).get('if-none-match')
+    if if_none_match and (
+        if_none_match.strip() == '*'
+        or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    ):
+        return Response(status_code=304, headers=headers)
+    return Response(content, media_type=media_type, headers=headers)
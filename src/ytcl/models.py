@@ -1,23 +1,28 @@
 import json
-import shlex
+import random
 import time
 import typing
 import urllib.error
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import List
+from typing import List, Optional
+from urllib.parse import urlencode
 from urllib.request import urlopen
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from icecream import ic  # noqa
 from peewee import *
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
 
 from . import common
+from . import file_index
 from . import youtube_api
 from .common import (
     VIDEOS_ROOT,
     FILES_ROOT,
     PREVIEW_ROOT,
+    VIDEO_FILE_EXTENSIONS,
     path2url,
-    call,
 )
 
 db = SqliteDatabase(
@@ -26,8 +31,6 @@ db = SqliteDatabase(
     check_same_thread=False,
 )
 
-VIDEO_FILE_EXTENSIONS = ['webm', 'mp4', 'mkv', 'avi']
-
 print_function = print
 
 
@@ -45,6 +48,18 @@ class Channel(Model):
     # useful to have especially since id column is not sequential.
     timestamp_added = IntegerField(default=now_unix)
 
+    # where the last update from YouTube got to.
+    # an update pages through the uploads newest-first, so it can stop
+    # once it reaches the newest video from last time,
+    # or anything as old as it, in case that video was deleted or made private.
+    newest_ytid = CharField(null=True)
+    newest_published_at = DateTimeField(null=True)
+    last_sync_epoch = IntegerField(null=True)
+    # a full sync goes through all the uploads,
+    # to refresh view counts and find videos that were made public later.
+    # if enabled, the server does them in the background, see full_sync_loop.
+    last_full_sync_epoch = IntegerField(null=True)
+
     def __str__(self):
         return f'<Channel: {self.name}, {self.id}>'
 
@@ -61,6 +76,35 @@ class Channel(Model):
 
         return app.router.url_path_for('UpdateFromYouTube') + '?channel_id=' + self.id
 
+    def full_sync_url(self):
+        return self.populate_videos_url() + '&full=1'
+
+    def needs_full_sync(self):
+        if not common.FULL_SYNC_DAYS:
+            return False
+        if not self.last_full_sync_epoch:
+            return True
+        age = now_unix() - self.last_full_sync_epoch
+        return age > common.FULL_SYNC_DAYS * 24 * 60 * 60
+
+    def save_sync_cursor(self, newest_item: dict, full: bool):
+        """newest_item is a video resource from the API"""
+        if newest_item:
+            self.newest_ytid = newest_item['id']
+            self.newest_published_at = youtube_api.published_at(newest_item)
+        self.last_sync_epoch = now_unix()
+        if full:
+            self.last_full_sync_epoch = self.last_sync_epoch
+        # only these, since a full sync in the background can overlap an update
+        self.save(
+            only=[
+                Channel.newest_ytid,
+                Channel.newest_published_at,
+                Channel.last_sync_epoch,
+                Channel.last_full_sync_epoch,
+            ]
+        )
+
     def youtube_url(self):
         return f'https://www.youtube.com/channel/{self.id}'
 
@@ -119,18 +163,6 @@ class Channel(Model):
     def num_videos(self):
         return Video.select().where(Video.channel == self).count()
 
-    def urls_of_preview_videos(self):
-        viewed_videos = self.videos(
-            where=[Video.local_view_count > 0], order_by=[Video.local_view_count.desc()]
-        )
-        for v in viewed_videos:
-            fp = v.preview_file_path()
-            if fp.exists():
-                yield v
-        for i, fp in enumerate(self.preview_video_paths()):
-            v = Video.get(ytid=fp.stem)
-            yield v
-
     def update_from_api(self):
         data = youtube_api.get_channel_api_data(self.youtube_url())
         del data['id']
@@ -139,21 +171,10 @@ class Channel(Model):
         self.save()
 
     def local_video_paths(self):
-        video_path = self.video_dir()
-        if not video_path.exists():
-            return
-        for p in video_path.iterdir():
-            if p.suffix[1:] in VIDEO_FILE_EXTENSIONS:
-                yield p
+        yield from file_index.downloaded.paths(self.id).values()
 
     def preview_video_paths(self):
-        # self.preview_video_dir_reencoded()
-        for video_path in [self.preview_video_dir(), self.preview_video_dir_shorter()]:
-            if not video_path.exists():
-                continue
-            for p in video_path.iterdir():
-                if p.suffix[1:] in VIDEO_FILE_EXTENSIONS:
-                    yield p
+        yield from file_index.previews.paths(self.id).values()
 
     # def get_videos_by_orientation(self, is_landscape, local_only=False) -> List['Video']:
     #     all_videos = Video.select().where(Video.width > Video.height == is_landscape)
@@ -162,9 +183,6 @@ class Channel(Model):
     #         return [v for v in all_videos if v.ytid in downloaded_ytids]
     #     return list(all_videos)
 
-    def num_local_videos(self):
-        return len(list(self.local_video_paths()))
-
     # @classmethod
     # def ranked_by_local_views(cls):
     #     channels = (cls
@@ -218,11 +236,19 @@ class Video(Model):
     download_status_epoch = IntegerField(null=True)
     # useful to have especially since id column is not sequential.
     added_locally_epoch = IntegerField(default=now_unix)
+    # base64 of a tiny PNG that the card shows until the real thumbnail loads,
+    # see common.thumbnail_placeholder
+    thumbnail_placeholder = TextField(null=True)
+    # the key of the video's row in the search index (see VideoSearch).
+    # not the rowid, since the primary key is ytid, so VACUUM can renumber the rowids.
+    # set by the insert trigger, see create_search_triggers.
+    search_id = IntegerField(null=True, unique=True)
 
     def set_download_status(self, status):
         self.download_status = status
         self.download_status_epoch = int(time.time())
-        self.save()
+        # the worker sets this while the server may be saving other fields
+        self.save(only=[Video.download_status, Video.download_status_epoch])
 
     def download_status_for_dl_button(self):
         """
@@ -243,20 +269,20 @@ class Video(Model):
         return status
 
     def thumbnail_path(self) -> Path:
-        return common.thumbnail_path(self.channel.thumbnail_dir(), self.ytid)
+        return common.thumbnail_path(
+            common.channel_thumbnail_dir(self.channel_id), self.ytid
+        )
 
     def views_per_like(self):
         yt_like_count = self.yt_like_count or 1
         return self.yt_view_count / yt_like_count
 
     def file_path(self):
-        path = None
-        video_dir = self.channel.video_dir()
-        for ext in VIDEO_FILE_EXTENSIONS:
-            path = video_dir.joinpath(f'{self.ytid}.{ext}')
-            if path.exists():
-                return path
-        return path
+        path = file_index.downloaded.get(self.ytid, self.channel_id)
+        if path:
+            return path
+        ext = VIDEO_FILE_EXTENSIONS[-1]
+        return VIDEOS_ROOT.joinpath(self.channel_id, f'{self.ytid}.{ext}')
 
     def is_recent(self):
         return (
@@ -296,19 +322,15 @@ class Video(Model):
         return max(self.width, self.height) < 2000
 
     def preview_file_path(self):
-        path = None
-        for video_dir in [
-            self.channel.preview_video_dir(),
-            self.channel.preview_video_dir_shorter(),
-        ]:
-            for ext in VIDEO_FILE_EXTENSIONS:
-                path = video_dir.joinpath(f'{self.ytid}.{ext}')
-                if path.exists():
-                    return path
-        return path
+        path = file_index.previews.get(self.ytid, self.channel_id)
+        if path:
+            return path
+        ext = VIDEO_FILE_EXTENSIONS[-1]
+        return common.PREVIEW_SHORT_ROOT.joinpath(self.channel_id, f'{self.ytid}.{ext}')
 
     def preview_url(self):
-        return path2url(self.preview_file_path())
+        path = self.preview_file_path()
+        return path2url(path, file_index.previews.version(path))
 
     # def schedule_appropriate_preview(self):
     #     if self.channel.auto_download_previews:
@@ -319,38 +341,56 @@ class Video(Model):
     #         self.schedule_download_preview_shorter()
 
     def schedule_download_preview(self):
-        QueuedTask.create(
-            operation='download_preview',
-            priority=3,
-            kwargs_json=json.dumps(
-                dict(ytid=self.ytid, channel_dir=str(self.channel.preview_video_dir()))
-            ),
-        )
+        Video.schedule_download_previews([self])
+
+    @staticmethod
+    def schedule_download_previews(videos):
+        """one batch task per channel, see tasks.download_previews"""
+        ytids_by_channel = {}
+        for video in videos:
+            # channel_id rather than channel, to avoid a query per video
+            ytids_by_channel.setdefault(video.channel_id, []).append(video.ytid)
+        with db.atomic():
+            for channel_id, ytids in ytids_by_channel.items():
+                QueuedTask.enqueue_batch(
+                    'download_previews',
+                    ytids,
+                    priority=3,
+                    channel_id=channel_id,
+                    channel_dir=str(common.PREVIEW_ROOT.joinpath(channel_id)),
+                )
+
+    @classmethod
+    def set_thumbnail_placeholders(cls, placeholders: dict):
+        """ytid -> placeholder. ytids that aren't in the DB are skipped."""
+        videos = [
+            cls(ytid=ytid, thumbnail_placeholder=placeholder)
+            for ytid, placeholder in placeholders.items()
+        ]
+        if videos:
+            cls.bulk_update(videos, fields=[cls.thumbnail_placeholder], batch_size=100)
+
+    @classmethod
+    def known_ytids(cls, ytids) -> set:
+        """which of these ytids are already in the DB"""
+        qs = cls.select(cls.ytid).where(cls.ytid.in_(list(ytids)))
+        return set(v.ytid for v in qs)
 
     def reencode_preview(self):
         """
-        todo: download to a temp dir
-        even though we can download from youtube, can't necessarily get rid of this
-        yet, because some videos have been deleted from youtube.
-        however, theoretically we won't need this if we download preview versions
-        before we down the full-size version. and i already re-encoded the legacy
-        downloaded videos
+        we can't necessarily download the preview from youtube,
+        because some videos have been deleted from youtube.
+        the worker does this automatically when the video is downloaded,
+        see tasks.fetch_preview.
         """
-        inp = self.file_path()
-        outdir = self.channel.preview_video_dir()
-        if not outdir.is_dir():
-            outdir.mkdir()
-        outp = outdir.joinpath(inp.name)
-
-        # don't rotate because we want to be consistent with preview-version videos
-        # downloaded from youtube. the rotating happens in HTML.
-        call(
-            'ffmpeg -ss 5 -t 20',
-            '-i',
-            shlex.quote(inp.as_posix()),
-            f'-vf "scale=360:-1" -crf 25 -y',
-            shlex.quote(outp.as_posix()),
+        # tasks imports this module
+        from .tasks import make_local_preview
+
+        format_stats = make_local_preview(
+            self.file_path(), common.PREVIEW_ROOT.joinpath(self.channel_id)
         )
+        Video.update(**format_stats).where(Video.ytid == self.ytid).execute()
+        file_index.previews.invalidate()
 
     def preview_height(self):
         w = self.width
@@ -359,14 +399,534 @@ class Video(Model):
             w, h = h, w
         return int(216 * h / w)
 
+    @classmethod
+    def search(cls, search_term):
+        """
+        every word must match the start of a word in the title,
+        so 'trav' finds 'Travel'. case and accents are folded by the tokenizer,
+        so 'cafe' also finds 'Café'.
+        """
+        phrases = []
+        for word in search_term.split():
+            # words that are only punctuation produce no tokens
+            # and would make the MATCH expression invalid.
+            if any(c.isalnum() for c in word):
+                word = word.replace('"', '""')
+                phrases.append(f'"{word}"*')
+        qs = cls.select().join(VideoSearch, on=(VideoSearch.rowid == cls.search_id))
+        if not phrases:
+            return qs.where(SQL('0'))
+        return qs.where(VideoSearch.match(' '.join(phrases)))
+
+
+class VideoSearch(FTS5Model):
+    """
+    full-text index of video titles, so that search doesn't have to
+    do a LIKE scan over the whole video table.
+    it's an external content table, so the titles are not stored twice.
+    its rows are keyed by Video.search_id.
+    kept in sync with the video table by triggers (see create_search_triggers),
+    so any code that inserts or updates videos doesn't need to know about it.
+    """
+
+    class Meta:
+        database = db
+        table_name = 'video_fts'
+        options = {
+            'content': 'video',
+            'content_rowid': 'search_id',
+            'tokenize': 'unicode61 remove_diacritics 2',
+        }
+
+    rowid = RowIDField()
+    title = SearchField()
+
+
+def create_search_triggers():
+    for sql in [
+        # the next search_id, and its index entry.
+        # MAX is just a lookup in search_id's unique index.
+        """
+        CREATE TRIGGER IF NOT EXISTS video_fts_ai AFTER INSERT ON video BEGIN
+            UPDATE video
+            SET search_id = (SELECT IFNULL(MAX(search_id), 0) + 1 FROM video)
+            WHERE ytid = new.ytid AND search_id IS NULL;
+            INSERT INTO video_fts(rowid, title)
+            SELECT search_id, title FROM video WHERE ytid = new.ytid;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS video_fts_ad AFTER DELETE ON video BEGIN
+            INSERT INTO video_fts(video_fts, rowid, title)
+            VALUES ('delete', old.search_id, old.title);
+        END
+        """,
+        # refreshing from youtube re-saves every known video,
+        # so only touch the index if the title actually changed.
+        """
+        CREATE TRIGGER IF NOT EXISTS video_fts_au AFTER UPDATE OF title ON video
+        WHEN old.title IS NOT new.title BEGIN
+            INSERT INTO video_fts(video_fts, rowid, title)
+            VALUES ('delete', old.search_id, old.title);
+            INSERT INTO video_fts(rowid, title) VALUES (new.search_id, new.title);
+        END
+        """,
+    ]:
+        db.execute_sql(sql)
+
+
+class ChannelStats(Model):
+    """
+    per-channel numbers for the home page, so it doesn't have to
+    count files and look up preview videos for every channel on every load.
+    kept up to date by refresh(), which is called when files change
+    (see file_index.on_change), when videos are added,
+    and when a video is watched.
+    """
+
+    class Meta:
+        database = db
+
+    channel = ForeignKeyField(Channel, primary_key=True, on_delete='CASCADE')
+    num_videos = IntegerField(default=0)
+    num_local_videos = IntegerField(default=0)
+    num_previews = IntegerField(default=0)
+    # space-separated, most watched first
+    preview_ytids = TextField(default='')
+    updated_epoch = IntegerField(default=now_unix)
+
+    PREVIEWS_PER_CHANNEL = 2
+
+    @classmethod
+    def refresh(cls, channel_id):
+        all_preview_ytids = file_index.previews.ytids(channel_id)
+        preview_videos = (
+            Video.select(Video.ytid)
+            .where(Video.channel == channel_id, Video.ytid.in_(all_preview_ytids))
+            .order_by(Video.local_view_count.desc())
+            .limit(cls.PREVIEWS_PER_CHANNEL)
+        )
+        fields = dict(
+            num_videos=Video.select().where(Video.channel == channel_id).count(),
+            num_local_videos=len(file_index.downloaded.ytids(channel_id)),
+            num_previews=len(all_preview_ytids),
+            preview_ytids=' '.join(v.ytid for v in preview_videos),
+            updated_epoch=now_unix(),
+        )
+        (
+            cls.insert(channel=channel_id, **fields)
+            .on_conflict(conflict_target=[cls.channel], update=fields)
+            .execute()
+        )
+
+    @classmethod
+    def refresh_missing(cls):
+        """e.g. for channels that were just added, or an existing library"""
+        channels = (
+            Channel.select(Channel.id)
+            .join(cls, JOIN.LEFT_OUTER)
+            .where(cls.channel.is_null())
+        )
+        for c in channels:
+            cls.refresh(c.id)
+
+    def preview_ytid_list(self):
+        return self.preview_ytids.split()
+
+
+def _on_channel_files_changed(channel_ids):
+    # the folder might belong to a channel that was deleted from the DB
+    for c in Channel.select(Channel.id).where(Channel.id.in_(list(channel_ids))):
+        ChannelStats.refresh(c.id)
+
+
+file_index.downloaded.on_change(_on_channel_files_changed)
+file_index.previews.on_change(_on_channel_files_changed)
+
+
+class TASK_STATUS:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    # failed too many times; kept so you can see what went wrong.
+    DEAD = 'dead'
+
 
 class QueuedTask(Model):
+    """
+    a worker claims a task by taking a lease on it.
+    if the worker dies, the lease runs out and another worker can claim it again.
+    a task that fails is retried later with exponential backoff,
+    until it runs out of attempts.
+    """
+
     class Meta:
         database = db  # This model uses the "people.db" database.
 
     operation = CharField()
     kwargs_json = TextField()
     priority = IntegerField(default=1)
+    # so that the same video isn't queued twice for the same operation
+    dedupe_key = CharField(null=True, unique=True)
+    status = CharField(default=TASK_STATUS.QUEUED)
+    claimed_by = CharField(null=True)
+    lease_expires_epoch = IntegerField(null=True)
+    attempts = IntegerField(default=0)
+    # don't run before this time (for backoff)
+    next_run_epoch = IntegerField(default=0)
+    last_error = TextField(null=True)
+
+    # workers renew the lease while the task is running,
+    # so this only needs to be long enough to survive a busy moment.
+    LEASE_SECONDS = 5 * 60
+    MAX_ATTEMPTS = 5
+    RETRY_BACKOFF_SECONDS = 30
+
+    @staticmethod
+    def make_dedupe_key(operation, kwargs: dict):
+        if 'ytid' in kwargs:
+            return f"{operation}:{kwargs['ytid']}"
+        # batches
+        if 'channel_id' in kwargs:
+            return f"{operation}:channel:{kwargs['channel_id']}"
+        # jobs for the whole library
+        return operation
+
+    @classmethod
+    def enqueue(cls, operation, priority=1, revive_dead=False, **kwargs):
+        cls.enqueue_many(operation, [kwargs], priority, revive_dead)
+
+    @classmethod
+    def enqueue_many(cls, operation, kwargs_list, priority=1, revive_dead=False):
+        """
+        in one transaction.
+        if a task is already queued for the same video, it just gets the higher
+        of the two priorities.
+        revive_dead is for when the user explicitly asked for it again,
+        so a task that had given up gets a fresh set of attempts.
+        """
+        rows = [
+            dict(
+                operation=operation,
+                kwargs_json=json.dumps(kwargs),
+                priority=priority,
+                dedupe_key=cls.make_dedupe_key(operation, kwargs),
+            )
+            for kwargs in kwargs_list
+        ]
+        update = {cls.priority: fn.MAX(cls.priority, EXCLUDED.priority)}
+        if revive_dead:
+            is_dead = cls.status == TASK_STATUS.DEAD
+            update.update(
+                {
+                    cls.status: Case(None, [(is_dead, TASK_STATUS.QUEUED)], cls.status),
+                    cls.attempts: Case(None, [(is_dead, 0)], cls.attempts),
+                    cls.next_run_epoch: Case(None, [(is_dead, 0)], cls.next_run_epoch),
+                }
+            )
+        with db.atomic():
+            # stay under SQLite's limit on the number of query parameters
+            for batch in chunked(rows, 100):
+                cls.insert_many(batch).on_conflict(
+                    conflict_target=[cls.dedupe_key], update=update
+                ).execute()
+
+    @classmethod
+    def enqueue_batch(cls, operation, ytids, priority=1, **kwargs):
+        """
+        a task for a list of videos from one channel.
+        there is only one queued batch per channel, so new ytids get added
+        to that batch rather than making a new task.
+        if the channel's batch is already running, the new ytids that aren't in it
+        go in a new batch.
+        a dead batch is revived with the new ytids, like enqueue_many's revive_dead,
+        since otherwise its ytids could never be queued again.
+        """
+        key = cls.make_dedupe_key(operation, kwargs)
+        with db.atomic():
+            task = cls.get_or_none(cls.dedupe_key == key)
+            old_ytids = json.loads(task.kwargs_json)['ytids'] if task else []
+            if task and task.status in (TASK_STATUS.QUEUED, TASK_STATUS.DEAD):
+                task.kwargs_json = json.dumps(
+                    dict(kwargs, ytids=list(dict.fromkeys(old_ytids + list(ytids))))
+                )
+                task.priority = max(task.priority, priority)
+                if task.status == TASK_STATUS.DEAD:
+                    task.status = TASK_STATUS.QUEUED
+                    task.attempts = 0
+                    task.next_run_epoch = 0
+                task.save(
+                    only=[
+                        cls.kwargs_json,
+                        cls.priority,
+                        cls.status,
+                        cls.attempts,
+                        cls.next_run_epoch,
+                    ]
+                )
+                return
+            ytids = [ytid for ytid in ytids if ytid not in old_ytids]
+            if not ytids:
+                return
+            if task:
+                # it keeps running but doesn't take new ytids anymore
+                task.dedupe_key = None
+                task.save(only=[cls.dedupe_key])
+            cls.create(
+                operation=operation,
+                kwargs_json=json.dumps(dict(kwargs, ytids=ytids)),
+                priority=priority,
+                dedupe_key=key,
+            )
+
+    @classmethod
+    def claim(cls, worker_id, operations) -> Optional['QueuedTask']:
+        """highest priority first, then oldest first"""
+        now = now_unix()
+        # IMMEDIATE so that two workers can't claim the same task
+        with db.atomic(lock_type='IMMEDIATE'):
+            cls._release_expired_leases(now)
+            task = (
+                cls.select()
+                .where(
+                    cls.status == TASK_STATUS.QUEUED,
+                    cls.operation.in_(operations),
+                    cls.next_run_epoch <= now,
+                )
+                .order_by(cls.priority.desc(), cls.id)
+                .first()
+            )
+            if task is None:
+                return None
+            task.status = TASK_STATUS.RUNNING
+            task.claimed_by = worker_id
+            task.lease_expires_epoch = now + cls.LEASE_SECONDS
+            task.attempts += 1
+            task.save(
+                only=[cls.status, cls.claimed_by, cls.lease_expires_epoch, cls.attempts]
+            )
+        return task
+
+    @classmethod
+    def _release_expired_leases(cls, now):
+        # the worker probably crashed or was killed. that counts as an attempt,
+        # so that a task that crashes the worker eventually stops being retried.
+        expired = (cls.status == TASK_STATUS.RUNNING) & (cls.lease_expires_epoch < now)
+        cls.update(
+            status=TASK_STATUS.DEAD, last_error='lease expired', claimed_by=None
+        ).where(expired, cls.attempts >= cls.MAX_ATTEMPTS).execute()
+        cls.update(
+            status=TASK_STATUS.QUEUED, last_error='lease expired', claimed_by=None
+        ).where(expired).execute()
+
+    @classmethod
+    def renew_leases(cls, worker_id, task_ids):
+        cls.update(lease_expires_epoch=now_unix() + cls.LEASE_SECONDS).where(
+            cls.id.in_(list(task_ids)), cls.claimed_by == worker_id
+        ).execute()
+
+    @classmethod
+    def seconds_until_next(cls) -> Optional[int]:
+        """for a worker to know when a task that is backing off will be ready"""
+        now = now_unix()
+        next_run = (
+            cls.select(fn.MIN(cls.next_run_epoch))
+            .where(cls.status == TASK_STATUS.QUEUED, cls.next_run_epoch > now)
+            .scalar()
+        )
+        if next_run is None:
+            return None
+        return next_run - now
+
+    def succeed(self):
+        self.delete_instance()
+
+    def fail(self, error: str):
+        self.claimed_by = None
+        self.lease_expires_epoch = None
+        self.last_error = error
+        if self.attempts >= self.MAX_ATTEMPTS:
+            self.status = TASK_STATUS.DEAD
+        else:
+            self.status = TASK_STATUS.QUEUED
+            backoff = self.RETRY_BACKOFF_SECONDS * 2 ** (self.attempts - 1)
+            self.next_run_epoch = now_unix() + int(backoff * random.uniform(1, 1.5))
+        # not the whole row: while it ran, enqueue_batch may have detached it
+        # (dedupe_key) or enqueue may have raised its priority.
+        self.save(
+            only=[
+                QueuedTask.claimed_by,
+                QueuedTask.lease_expires_epoch,
+                QueuedTask.last_error,
+                QueuedTask.status,
+                QueuedTask.next_run_epoch,
+            ]
+        )
+
+    def retry(self):
+        """give a dead task another full set of attempts"""
+        self.status = TASK_STATUS.QUEUED
+        self.attempts = 0
+        self.next_run_epoch = 0
+        self.save(
+            only=[QueuedTask.status, QueuedTask.attempts, QueuedTask.next_run_epoch]
+        )
+
+
+# matches the order of claim, so it doesn't have to sort the whole queue
+QueuedTask.add_index(QueuedTask.status, QueuedTask.priority.desc(), QueuedTask.id)
+
+
+class ApiCache(Model):
+    """
+    responses from the YouTube API, with their ETags,
+    so that repeated updates can send If-None-Match and get a 304 back,
+    or skip the request entirely while the response is still fresh.
+    see youtube_api.yt_request.
+    """
+
+    class Meta:
+        database = db
+
+    key = TextField(primary_key=True)
+    resource = CharField()
+    etag = TextField(null=True)
+    body = TextField()
+    fetched_epoch = IntegerField(default=now_unix)
+
+    # entries that haven't been fetched or revalidated in this long
+    # are probably for channels/pages we don't ask for anymore.
+    MAX_AGE_DAYS = 30
+
+    @staticmethod
+    def make_key(resource, params: dict):
+        return resource + '?' + urlencode(sorted(params.items()))
+
+    @classmethod
+    def store(cls, key, resource, etag, body: str):
+        fields = dict(resource=resource, etag=etag, body=body, fetched_epoch=now_unix())
+        cls.insert(key=key, **fields).on_conflict(
+            conflict_target=[cls.key], update=fields
+        ).execute()
+
+    @classmethod
+    def prune(cls):
+        cutoff = now_unix() - cls.MAX_AGE_DAYS * 24 * 60 * 60
+        cls.delete().where(cls.fetched_epoch < cutoff).execute()
+
+
+def quota_day():
+    """the YouTube API quota resets at midnight Pacific time"""
+    try:
+        tz = ZoneInfo('America/Los_Angeles')
+    except ZoneInfoNotFoundError:
+        # e.g. on Windows without the tzdata package. ignore DST.
+        tz = timezone(timedelta(hours=-8))
+    return datetime.now(tz).date().isoformat()
+
+
+class QuotaLedger(Model):
+    """
+    YouTube API quota units spent per day, per resource.
+    it's in the DB so that every process that calls the API adds to the same count.
+    """
+
+    class Meta:
+        database = db
+        indexes = ((('day', 'resource'), True),)
+
+    day = CharField()
+    resource = CharField()
+    calls = IntegerField(default=0)
+    units = IntegerField(default=0)
+
+    # not a real resource; recorded when YouTube says we're out of quota,
+    # so that we stop asking for the rest of the day.
+    EXHAUSTED = 'quota_exceeded'
+
+    @classmethod
+    def record(cls, resource, units, calls=1):
+        row = dict(day=quota_day(), resource=resource, calls=calls, units=units)
+        cls.insert(**row).on_conflict(
+            conflict_target=[cls.day, cls.resource],
+            update={cls.calls: cls.calls + calls, cls.units: cls.units + units},
+        ).execute()
+
+    @classmethod
+    def used_today(cls) -> int:
+        return (
+            cls.select(fn.COALESCE(fn.SUM(cls.units), 0))
+            .where(cls.day == quota_day())
+            .scalar()
+        )
+
+    @classmethod
+    def remaining_today(cls) -> int:
+        return max(common.API_DAILY_QUOTA - cls.used_today(), 0)
+
+    @classmethod
+    def mark_exhausted(cls):
+        cls.record(cls.EXHAUSTED, cls.remaining_today(), calls=0)
+
+    @classmethod
+    def recent_days(cls, num_days=7):
+        """[(day, units)], newest first"""
+        return list(
+            cls.select(cls.day, fn.SUM(cls.units))
+            .group_by(cls.day)
+            .order_by(cls.day.desc())
+            .limit(num_days)
+            .tuples()
+        )
+
+
+class RateLimiter(Model):
+    """
+    token bucket, stored in the DB so it's shared by all processes.
+    """
+
+    class Meta:
+        database = db
+
+    name = CharField(primary_key=True)
+    tokens = FloatField()
+    updated = FloatField()
+
+    @classmethod
+    def reserve(cls, name, rate, burst) -> float:
+        """
+        takes a token, and returns how many seconds to wait before using it.
+        the bucket can go negative, so that callers that arrive at the same time
+        queue up behind each other instead of all retrying at once.
+        """
+        now = time.time()
+        # IMMEDIATE so that two processes can't read the same count
+        with db.atomic(lock_type='IMMEDIATE'):
+            bucket = cls.get_or_none(cls.name == name)
+            if bucket is None:
+                bucket = cls.create(name=name, tokens=burst, updated=now)
+            tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            tokens -= 1
+            cls.update(tokens=tokens, updated=now).where(cls.name == name).execute()
+        if tokens >= 0:
+            return 0
+        return -tokens / rate
+
+
+class PackedThumbnail(Model):
+    """
+    where a thumbnail is in its channel's pack file, see thumbnail_pack.
+    """
+
+    class Meta:
+        database = db
+        indexes = ((('ytid', 'size'), True),)
+
+    ytid = CharField()
+    # thumbnail_pack.FULL or thumbnail_pack.SMALL
+    size = CharField()
+    channel_id = CharField(index=True)
+    offset = IntegerField()
+    length = IntegerField()
 
 
 def get_downloaded_paths(orientation=None, channel=None) -> List[Path]:
@@ -380,24 +940,8 @@ def get_downloaded_paths(orientation=None, channel=None) -> List[Path]:
         qs = qs.where(Video.channel == channel)
     oriented_ytids = set(v.ytid for v in qs)
     paths = []
-    for path in get_all_downloaded_paths():
-        if path.stem in oriented_ytids:
-            paths.append(path)
-    return paths
-
-
-def get_all_downloaded_paths():
-    paths = []
-    for ext in VIDEO_FILE_EXTENSIONS:
-        for path in VIDEOS_ROOT.glob(f'**/*.{ext}'):
-            paths.append(path)
-    return paths
-
-
-def get_all_preview_paths():
-    paths = []
-    for ext in VIDEO_FILE_EXTENSIONS:
-        for path in PREVIEW_ROOT.glob(f'**/*.{ext}'):
+    for ytid, path in file_index.downloaded.paths().items():
+        if ytid in oriented_ytids:
             paths.append(path)
     return paths
 
@@ -414,22 +958,108 @@ def migrate():
 
     migrator = SqliteMigrator(db)
 
+    # for a new library, the tables are created from scratch in main(),
+    # so there is nothing to migrate.
     if user_version == 0:
         pass
-    elif user_version < 2:
-        migrate(migrator.add_column('video', 'download_status', Video.download_status))
-        migrate(
-            migrator.rename_column(
-                'video', 'download_requested_epoch', 'download_status_epoch'
+    else:
+        if user_version < 2:
+            migrate(
+                migrator.add_column('video', 'download_status', Video.download_status)
             )
-        )
-        migrate(
-            migrator.rename_column(
-                'video', 'timestamp_added_locally', 'added_locally_epoch'
+            migrate(
+                migrator.rename_column(
+                    'video', 'download_requested_epoch', 'download_status_epoch'
+                )
+            )
+            migrate(
+                migrator.rename_column(
+                    'video', 'timestamp_added_locally', 'added_locally_epoch'
+                )
+            )
+        if user_version < 3:
+            # not the rowid, see Video.search_id
+            migrate(migrator.add_column('video', 'search_id', Video.search_id))
+            # the rowids are unique, so they make fine starting values
+            Video.update(search_id=SQL('rowid')).execute()
+            VideoSearch.create_table()
+            create_search_triggers()
+            # backfill the index from the existing titles
+            VideoSearch.rebuild()
+        if user_version < 4:
+            migrate(
+                migrator.add_column('channel', 'newest_ytid', Channel.newest_ytid),
+                migrator.add_column(
+                    'channel', 'newest_published_at', Channel.newest_published_at
+                ),
+                migrator.add_column(
+                    'channel', 'last_sync_epoch', Channel.last_sync_epoch
+                ),
+                migrator.add_column(
+                    'channel', 'last_full_sync_epoch', Channel.last_full_sync_epoch
+                ),
+            )
+            # until now, updating a single channel always went through all its videos,
+            # so don't make every channel do a full sync right away.
+            # spread them out over the full sync period instead of all on one day.
+            full_sync_seconds = common.FULL_SYNC_DAYS * 24 * 60 * 60
+            for channel in list(Channel.select(Channel.id)):
+                stagger = full_sync_seconds and random.randrange(full_sync_seconds)
+                Channel.update(last_full_sync_epoch=now_unix() - stagger).where(
+                    Channel.id == channel.id
+                ).execute()
+        if user_version < 5:
+            migrate(
+                migrator.add_column('queuedtask', 'status', QueuedTask.status),
+                migrator.add_column('queuedtask', 'claimed_by', QueuedTask.claimed_by),
+                migrator.add_column(
+                    'queuedtask', 'lease_expires_epoch', QueuedTask.lease_expires_epoch
+                ),
+                migrator.add_column('queuedtask', 'attempts', QueuedTask.attempts),
+                migrator.add_column(
+                    'queuedtask', 'next_run_epoch', QueuedTask.next_run_epoch
+                ),
+                migrator.add_column('queuedtask', 'last_error', QueuedTask.last_error),
+            )
+            # replaced by the index that starts with status
+            db.execute_sql('DROP INDEX IF EXISTS queuedtask_priority_id')
+        if user_version < 6:
+            # this also adds the unique index
+            migrate(
+                migrator.add_column('queuedtask', 'dedupe_key', QueuedTask.dedupe_key)
+            )
+            tasks = list(QueuedTask.select().order_by(QueuedTask.id))
+            with db.atomic():
+                first_tasks = {}
+                for task in tasks:
+                    key = QueuedTask.make_dedupe_key(
+                        task.operation, json.loads(task.kwargs_json)
+                    )
+                    first = first_tasks.get(key)
+                    if first is None:
+                        first_tasks[key] = task
+                        task.dedupe_key = key
+                        task.save()
+                    else:
+                        first.priority = max(first.priority, task.priority)
+                        if (
+                            first.status == TASK_STATUS.DEAD
+                            and task.status != TASK_STATUS.DEAD
+                        ):
+                            # like revive_dead, so the duplicate's work isn't lost
+                            first.status = TASK_STATUS.QUEUED
+                            first.attempts = 0
+                            first.next_run_epoch = 0
+                        first.save()
+                        task.delete_instance()
+        if user_version < 7:
+            migrate(
+                migrator.add_column(
+                    'video', 'thumbnail_placeholder', Video.thumbnail_placeholder
+                )
             )
-        )
 
-    new_user_version = 2
+    new_user_version = 7
     if user_version < new_user_version:
         cur.execute(f"PRAGMA user_version = {new_user_version}")
 
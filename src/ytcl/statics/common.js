@@ -18,3 +18,51 @@ function vlc(btn) {
       data: {path: btn.value},
   });
 }
+
+/*
+Cards start out with a tiny placeholder that's inlined in the page,
+and only load their real thumbnail when they're about to scroll into view.
+That way a big channel page doesn't start with hundreds of image requests.
+Cards that are added after this runs, e.g. streamed in while updating
+from YouTube, are picked up as they're inserted.
+*/
+function loadThumbnails() {
+  let observer = new IntersectionObserver((entries) => {
+    entries.forEach((entry) => {
+      if (!entry.isIntersecting) {
+        return;
+      }
+      let img = entry.target;
+      observer.unobserve(img);
+      // swap once it's loaded, so the card doesn't go blank in between
+      let full = new Image();
+      full.onload = function () {
+        img.src = full.src;
+        img.classList.remove('thumbnail-placeholder');
+      };
+      full.src = img.dataset.src;
+    });
+  }, {rootMargin: '500px'});
+  function observePlaceholders(element) {
+    if (element.matches('img.thumbnail-placeholder')) {
+      observer.observe(element);
+    }
+    for (let img of element.querySelectorAll('img.thumbnail-placeholder')) {
+      observer.observe(img);
+    }
+  }
+  observePlaceholders(document.documentElement);
+  new MutationObserver((mutations) => {
+    mutations.forEach((mutation) => {
+      for (let node of mutation.addedNodes) {
+        if (node.nodeType === Node.ELEMENT_NODE) {
+          observePlaceholders(node);
+        }
+      }
+    });
+  }).observe(document.documentElement, {childList: true, subtree: true});
+}
+
+// right away rather than on DOMContentLoaded, which a streamed page
+// only gets once it's done.
+loadThumbnails();
@@ -1,11 +1,30 @@
 import logging
 import json
+import multiprocessing
+import os
+import shlex
+import shutil
+import socket
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from ytcl.common import download_video_file_info, print_function, YT_DLP_CMD, TEMP_DIR
 
+from peewee import chunked
+from ytcl.common import print_function, YT_DLP_CMD, TEMP_DIR
+
+from . import common
+from . import file_index
+from . import thumbnail_pack
+from . import wakeup
 from .common import call, YT_DLP_CMD, TEMP_DIR, YT_DLP_FLAGS
-from .models import Video, DOWNLOAD_STATUS, QueuedTask
+from .models import (
+    Video,
+    DOWNLOAD_STATUS,
+    QueuedTask,
+    TASK_STATUS,
+    ChannelStats,
+)
 from icecream import ic  # noqa
 
 print_function = print
@@ -16,26 +35,93 @@ logger = logging.getLogger(__name__)
 
 def listen():
     print_function("Worker is listening for messages")
+    listener = wakeup.Listener()
+    pool = WorkerPool(common.WORKER_CONCURRENCY)
+    pruned_at = 0
 
     while True:
-        task: QueuedTask = (
-            QueuedTask.select().order_by(QueuedTask.priority.desc()).first()
-        )
-        if not task:
-            time.sleep(5)
-            continue
-        operation = task.operation
+        if time.time() - pruned_at > 60 * 60:
+            common.prune_video_info()
+            pruned_at = time.time()
+        # wait() returns at least once a minute, well within the lease.
+        pool.renew_leases()
+        if not pool.start_tasks():
+            # a finished task also wakes us up, since its slot is free again.
+            listener.wait(timeout=QueuedTask.seconds_until_next())
+
+
+class WorkerPool:
+    """
+    runs several tasks at once, with a separate limit per operation,
+    so that previews don't have to wait behind a big download.
+    each slot has its own temp dir, so that yt-dlp's partial files
+    from different tasks never mix.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        # unique across machines, in case the library is on a shared drive
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self._lock = threading.Lock()
+        # operation -> free slot numbers
+        self._free_slots = {op: list(range(n)) for op, n in limits.items()}
+        # task id -> operation
+        self._running = {}
+        for op, n in limits.items():
+            for slot in range(n):
+                self.temp_dir(op, slot).mkdir(exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=sum(limits.values()))
+
+    @staticmethod
+    def temp_dir(operation, slot) -> Path:
+        return TEMP_DIR.joinpath(f'{operation}-{slot}')
+
+    def start_tasks(self) -> int:
+        """start as many queued tasks as there are free slots. returns how many."""
+        num_started = 0
+        while True:
+            with self._lock:
+                operations = [op for op, slots in self._free_slots.items() if slots]
+            if not operations:
+                return num_started
+            task = QueuedTask.claim(self.worker_id, operations)
+            if not task:
+                return num_started
+            with self._lock:
+                slot = self._free_slots[task.operation].pop()
+                self._running[task.id] = task.operation
+            self._executor.submit(self._run, task, slot)
+            num_started += 1
+
+    def renew_leases(self):
+        with self._lock:
+            running_ids = list(self._running)
+        if running_ids:
+            QueuedTask.renew_leases(self.worker_id, running_ids)
+
+    def _run(self, task: QueuedTask, slot):
         kwargs = json.loads(task.kwargs_json)
-        fxns = dict(download=download, download_preview=download_preview)
-        fxn = fxns[operation]
+        fxn = OPERATIONS[task.operation]
         try:
-            fxn(**kwargs)
+            fxn(**kwargs, temp_dir=self.temp_dir(task.operation, slot))
         except Exception as exc:
             logger.exception(repr(exc))
-        task.delete_instance()
+            task.fail(repr(exc))
+            if task.status == TASK_STATUS.DEAD:
+                print_function(
+                    f"Giving up on {task.operation} {kwargs} "
+                    f"after {task.attempts} attempts"
+                )
+        else:
+            task.succeed()
+        finally:
+            with self._lock:
+                del self._running[task.id]
+                self._free_slots[task.operation].append(slot)
+            wakeup.notify()
 
 
-def download(ytid, channel_dir: str, preview_channel_dir: str):
+def download(ytid, channel_dir: str, preview_channel_dir: str, temp_dir=TEMP_DIR):
     channel_dir = Path(channel_dir)
     # youtube seems to be blocking me and returning 403 partway through
     # the download:
@@ -45,57 +131,326 @@ def download(ytid, channel_dir: str, preview_channel_dir: str):
     # then downloads fine through the CLI
 
     # yes this works! i don't get the download limit.
+    # so if downloading from the info fails, we try once more with the CLI.
 
+    flags = shlex.split(YT_DLP_FLAGS) + [
+        '--output',
+        f"{ytid}.%(ext)s",
+        '--paths',
+        f"temp:{Path(temp_dir).as_posix()}",
+        '--paths',
+        f"home:{channel_dir.as_posix()}",
+    ]
     try:
-        call(
-            YT_DLP_CMD,
-            YT_DLP_FLAGS,
-            f'https://www.youtube.com/watch?v={ytid}',
-            '--output',
-            f"{ytid}.%(ext)s",
-            '--paths',
-            f"temp:{TEMP_DIR.as_posix()}",
-            '--paths',
-            f"home:{channel_dir.as_posix()}",
-        )
+        # if we got a preview of this video recently, this reuses its info.
+        info_path = common.extract_video_info(ytid)
+        try:
+            if not info_path:
+                raise Exception(f"Cannot get info about {ytid}")
+            run_yt_dlp(info_path, flags)
+        except Exception:
+            # besides the 403s, the format URLs in the info might have expired,
+            # so start over from the watch URL.
+            print_function(f"Couldn't download {ytid}, retrying with the yt-dlp CLI")
+            if info_path:
+                info_path.unlink(missing_ok=True)
+            call(
+                YT_DLP_CMD,
+                *[shlex.quote(flag) for flag in flags],
+                f'https://www.youtube.com/watch?v={ytid}',
+            )
     except Exception as exc:
         video = Video.get(ytid=ytid)
         video.set_download_status(DOWNLOAD_STATUS.FAILED)
         video.save()
         raise
+    # yt-dlp picks the extension, so we don't know the exact filename.
+    file_index.downloaded.invalidate(channel_dir)
     video = Video.get(ytid=ytid)
     video.set_download_status(DOWNLOAD_STATUS.DOWNLOADED)
     video.save()
+    ChannelStats.refresh(video.channel_id)
 
-    download_preview(ytid, preview_channel_dir)
+    download_preview(ytid, preview_channel_dir, temp_dir=temp_dir)
     print_function(f"Downloaded {ytid}: video and preview")
 
 
-def download_preview(ytid, channel_dir: str, ss=5, to=25):
+def download_preview(ytid, channel_dir: str, ss=5, to=25, temp_dir=TEMP_DIR):
+    channel_dir = Path(channel_dir)
+    format_stats = fetch_preview(ytid, channel_dir, ss, to, temp_dir)
+    if format_stats:
+        Video.update(**format_stats).where(Video.ytid == ytid).execute()
+    file_index.previews.invalidate(channel_dir)
+    ChannelStats.refresh(channel_dir.name)
+
+
+def download_previews(ytids, channel_id, channel_dir: str, temp_dir=TEMP_DIR):
+    """
+    previews for a list of videos from one channel, a few at a time.
+    if some fail, the task fails and the retry only fetches the ones still missing.
+    """
     channel_dir = Path(channel_dir)
+    file_index.previews.invalidate(channel_dir)
+    have_preview = file_index.previews.ytids(channel_id)
+    videos = list(
+        Video.select(Video.ytid, Video.height).where(Video.ytid.in_(ytids))
+    )
+    # part of the preview is the format stats, see schedule_download_previews_chunk
+    todo = [v.ytid for v in videos if not (v.ytid in have_preview and v.height)]
+
+    def fetch(ytid):
+        # each one gets its own temp dir, within the slot's temp dir
+        ytid_temp_dir = Path(temp_dir).joinpath(ytid)
+        ytid_temp_dir.mkdir(exist_ok=True)
+        try:
+            return ytid, fetch_preview(ytid, channel_dir, temp_dir=ytid_temp_dir)
+        except Exception as exc:
+            logger.exception(repr(exc))
+            return ytid, None
+        finally:
+            shutil.rmtree(ytid_temp_dir, ignore_errors=True)
+
+    with ThreadPoolExecutor(max_workers=common.PREVIEW_BATCH_CONCURRENCY) as executor:
+        results = list(executor.map(fetch, todo))
+
+    updated_videos = [Video(ytid=ytid, **stats) for ytid, stats in results if stats]
+    if updated_videos:
+        # one UPDATE for the whole batch
+        Video.bulk_update(updated_videos, fields=['width', 'height', 'fps'])
+    file_index.previews.invalidate(channel_dir)
+    ChannelStats.refresh(channel_id)
+
+    failed = [ytid for ytid, stats in results if not stats]
+    print_function(
+        f"Downloaded {len(updated_videos)} previews for {channel_id}, "
+        f"{len(failed)} failed"
+    )
+    if failed:
+        raise Exception(f"Could not download previews: {' '.join(failed)}")
+
+
+def fetch_preview(ytid, channel_dir: Path, ss=5, to=25, temp_dir=TEMP_DIR):
+    """
+    makes the clip and returns the format stats, without touching the DB.
+    only goes to YouTube if we don't have the video on disk.
+    """
+    source = file_index.downloaded.get(ytid, channel_dir.name)
+    if source:
+        try:
+            return make_local_preview(source, channel_dir, ss, to, temp_dir)
+        except Exception as exc:
+            logger.exception(repr(exc))
+            print_function(f"Couldn't make a preview from {source}, downloading one")
 
     # download format stats because we need this in order to display
     # the preview clip with proper orientation.
-    format_stats = download_video_file_info(ytid=ytid)
+    # the same info is then used to download the clip,
+    # so that yt-dlp only has to extract it once.
+    info_path = common.extract_video_info(ytid)
 
-    if not format_stats:
+    if not info_path:
         print_function(f"ERROR: cannot get info about {ytid}, skipping")
         return
 
-    from .models import Video
+    run_yt_dlp(
+        info_path,
+        [
+            '--output',
+            f"{ytid}.%(ext)s",
+            '--downloader',
+            'ffmpeg',
+            '--downloader-args',
+            f"ffmpeg_i:-ss {ss} -to {to}",
+            '-S',
+            'res:360',
+            '-f',
+            'bv',
+            '--paths',
+            f"temp:{Path(temp_dir).as_posix()}",
+            '--paths',
+            f"home:{channel_dir.as_posix()}",
+        ],
+    )
+    return common.get_format_stats(info_path)
 
-    Video.update(**format_stats).where(Video.ytid == ytid).execute()
 
-    call(
-        YT_DLP_CMD,
-        f'https://www.youtube.com/watch?v={ytid}',
-        '--output',
-        f"{ytid}.%(ext)s",
-        f"""--downloader ffmpeg --downloader-args "ffmpeg_i:-ss {ss} -to {to}" """,
-        """ -S "res:360" """,
-        """ -f "bv" """,
-        '--paths',
-        f"temp:{TEMP_DIR.as_posix()}",
-        '--paths',
-        f"home:{channel_dir.as_posix()}",
+def make_local_preview(source: Path, channel_dir: Path, ss=5, to=25, temp_dir=TEMP_DIR):
+    """cuts the preview out of a downloaded video, and returns its format stats"""
+    format_stats = common.probe_video(source)
+    duration = format_stats.pop('duration')
+    if duration and duration < to:
+        # short video, just take it from the start
+        ss, to = 0, min(to - ss, duration)
+    tmp_path = Path(temp_dir).joinpath(f'{source.stem}.mp4')
+    common.cut_preview(source, tmp_path, ss, to)
+    channel_dir.mkdir(exist_ok=True)
+    shutil.move(tmp_path, channel_dir.joinpath(tmp_path.name))
+    return format_stats
+
+
+def _lower_priority():
+    # children like ffmpeg inherit it.
+    # os.nice doesn't exist on Windows; there it just runs at normal priority.
+    if hasattr(os, 'nice'):
+        os.nice(common.PREVIEW_ENCODE_NICENESS)
+
+
+def _encoding_pool():
+    return ProcessPoolExecutor(
+        max_workers=common.PREVIEW_ENCODE_PROCESSES,
+        initializer=_lower_priority,
+        # not fork, since the worker has other threads running
+        mp_context=multiprocessing.get_context('spawn'),
     )
+
+
+def _local_preview_job(source: str, channel_dir: str, temp_dir: str):
+    # runs in a separate process, so keep the arguments and result simple
+    ytid_temp_dir = Path(temp_dir).joinpath(Path(source).stem)
+    ytid_temp_dir.mkdir(exist_ok=True)
+    try:
+        return make_local_preview(
+            Path(source), Path(channel_dir), temp_dir=ytid_temp_dir
+        )
+    finally:
+        shutil.rmtree(ytid_temp_dir, ignore_errors=True)
+
+
+def backfill_local_previews(temp_dir=TEMP_DIR):
+    """
+    makes previews for all downloaded videos that don't have one,
+    in a pool of low-priority processes since it's CPU-bound.
+    """
+    have_preview = file_index.previews.ytids()
+    sources = {
+        ytid: path
+        for ytid, path in file_index.downloaded.paths().items()
+        if ytid not in have_preview
+    }
+    results = {}
+    with _encoding_pool() as executor:
+        futures = {
+            executor.submit(
+                _local_preview_job,
+                str(path),
+                str(common.PREVIEW_ROOT.joinpath(path.parent.name)),
+                str(temp_dir),
+            ): ytid
+            for ytid, path in sources.items()
+        }
+        for future in as_completed(futures):
+            ytid = futures[future]
+            try:
+                results[ytid] = future.result()
+            except Exception as exc:
+                print_function(f"Couldn't make a preview from {sources[ytid]}: {exc!r}")
+
+    # videos that were put in the folder by hand might not be in the DB,
+    # but then this just doesn't update anything for them.
+    updated_videos = [Video(ytid=ytid, **stats) for ytid, stats in results.items()]
+    if updated_videos:
+        Video.bulk_update(updated_videos, fields=['width', 'height', 'fps'])
+    file_index.previews.invalidate()
+    for channel_id in set(sources[ytid].parent.name for ytid in results):
+        ChannelStats.refresh(channel_id)
+    print_function(f"Made {len(results)} of {len(sources)} missing previews")
+
+
+def backfill_small_thumbnails(temp_dir=TEMP_DIR):
+    """for thumbnails that were downloaded before we made small ones"""
+    have_small = file_index.small_thumbnails.ytids()
+    paths = [
+        path
+        for ytid, path in file_index.thumbnails.paths().items()
+        if ytid not in have_small
+    ]
+    packed = thumbnail_pack.missing_small()
+    num_made = 0
+    with _encoding_pool() as executor:
+        # in chunks, since each one is quick
+        num_made += sum(executor.map(common.make_small_thumbnail, paths, chunksize=20))
+        for batch in chunked(packed, 200):
+            contents = [thumbnail_pack.read(ytid) or b'' for _, ytid in batch]
+            smalls = executor.map(common.small_thumbnail_bytes, contents, chunksize=20)
+            for (channel_id, ytid), small in zip(batch, smalls):
+                if small:
+                    thumbnail_pack.add_many(
+                        channel_id, [(ytid, thumbnail_pack.SMALL, small)]
+                    )
+                    num_made += 1
+    file_index.small_thumbnails.invalidate()
+    print_function(f"Made {num_made} of {len(paths) + len(packed)} small thumbnails")
+
+
+def _read_card_thumbnail(ytid, channel_id):
+    """the small one if there is one, since it's quicker to decode"""
+    packed_sizes = thumbnail_pack.index.sizes(ytid)
+    for size, files in [
+        (thumbnail_pack.SMALL, file_index.small_thumbnails),
+        (thumbnail_pack.FULL, file_index.thumbnails),
+    ]:
+        if size in packed_sizes:
+            return thumbnail_pack.read(ytid, size)
+        path = files.get(ytid, channel_id)
+        if path:
+            return path.read_bytes()
+
+
+def backfill_thumbnail_placeholders(temp_dir=TEMP_DIR):
+    """for videos whose thumbnails were downloaded before we made placeholders"""
+    videos = list(
+        Video.select(Video.ytid, Video.channel)
+        .where(Video.thumbnail_placeholder.is_null())
+        .tuples()
+    )
+    num_made = 0
+    with _encoding_pool() as executor:
+        for batch in chunked(videos, 200):
+            contents = {}
+            for ytid, channel_id in batch:
+                content = _read_card_thumbnail(ytid, channel_id)
+                if content:
+                    contents[ytid] = content
+            placeholders = executor.map(
+                common.thumbnail_placeholder, contents.values(), chunksize=20
+            )
+            placeholders = dict(zip(contents, placeholders))
+            Video.set_thumbnail_placeholders(
+                {ytid: p for ytid, p in placeholders.items() if p}
+            )
+            num_made += sum(1 for p in placeholders.values() if p)
+    print_function(f"Made {num_made} of {len(videos)} thumbnail placeholders")
+
+
+def pack_thumbnails(temp_dir=TEMP_DIR):
+    thumbnail_pack.pack_directories()
+
+
+def unpack_thumbnails(temp_dir=TEMP_DIR):
+    thumbnail_pack.unpack_to_directories()
+
+
+def run_yt_dlp(info_path: Path, flags: list, in_process=None):
+    """
+    download from the info that common.extract_video_info saved.
+    if the format URLs in it stopped working, yt-dlp extracts the info again.
+    """
+    if in_process is None:
+        in_process = common.YT_DLP_IN_PROCESS
+    if in_process:
+        common.YTDL.download(info_path, flags)
+    else:
+        flags = ['--load-info-json', info_path.as_posix()] + flags
+        call(YT_DLP_CMD, *[shlex.quote(flag) for flag in flags])
+
+
+OPERATIONS = dict(
+    download=download,
+    download_preview=download_preview,
+    download_previews=download_previews,
+    backfill_local_previews=backfill_local_previews,
+    backfill_small_thumbnails=backfill_small_thumbnails,
+    pack_thumbnails=pack_thumbnails,
+    unpack_thumbnails=unpack_thumbnails,
+    backfill_thumbnail_placeholders=backfill_thumbnail_placeholders,
+)
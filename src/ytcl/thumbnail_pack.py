@@ -0,0 +1,256 @@
+"""
+Optional storage for video thumbnails, for big libraries.
+Instead of thumbnails/<channel_id>/<ytid>.jpg, all of a channel's thumbnails
+are appended to one file, thumbnail_packs/<channel_id>.pack,
+and the PackedThumbnail table says where in the file each one is.
+
+Hundreds of thousands of tiny files make scanning, backing up and copying a library
+slow, since each file is a separate seek. A pack is read and written sequentially.
+Turn it on with `thumbnail_packs = true` in settings.toml, so that new thumbnails
+go into packs. The thumbnails you already have can be moved into the packs
+(or back out of them) from the status page.
+
+Packs are append-only. Replacing a thumbnail appends the new one and
+points the index to it, leaving the old bytes as dead space.
+The web server reads them through mmap.
+"""
+
+import mmap
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from peewee import JOIN, chunked, fn
+
+from . import common
+from . import file_index
+from .common import THUMBNAIL_PACKS_ROOT, THUMBNAILS_ROOT, SMALL_THUMBNAILS_ROOT
+from .models import db, PackedThumbnail
+
+FULL = 'full'
+SMALL = 'small'
+
+_ROOTS = {FULL: THUMBNAILS_ROOT, SMALL: SMALL_THUMBNAILS_ROOT}
+
+# how many thumbnails to hold in memory at once when moving them in or out of packs
+_BATCH_SIZE = 200
+
+
+def pack_path(channel_id) -> Path:
+    return THUMBNAIL_PACKS_ROOT.joinpath(f'{channel_id}.pack')
+
+
+def add_many(channel_id, thumbnails):
+    """thumbnails is a list of (ytid, size, content), all from the same channel"""
+    path = pack_path(channel_id)
+    path.parent.mkdir(exist_ok=True)
+    rows = []
+    # IMMEDIATE, so that two processes can't append to the same pack at once
+    # and both record the same offset.
+    with db.atomic(lock_type='IMMEDIATE'):
+        with open(path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            for ytid, size, content in thumbnails:
+                f.write(content)
+                rows.append(
+                    dict(
+                        ytid=ytid,
+                        size=size,
+                        channel_id=channel_id,
+                        offset=offset,
+                        length=len(content),
+                    )
+                )
+                offset += len(content)
+        for batch in chunked(rows, 100):
+            PackedThumbnail.insert_many(batch).on_conflict(
+                conflict_target=[PackedThumbnail.ytid, PackedThumbnail.size],
+                preserve=[
+                    PackedThumbnail.channel_id,
+                    PackedThumbnail.offset,
+                    PackedThumbnail.length,
+                ],
+            ).execute()
+
+
+# channel_id -> (inode, map)
+_maps: Dict[str, tuple] = {}
+_maps_lock = threading.Lock()
+
+
+def read(ytid, size=FULL) -> Optional[bytes]:
+    entry = PackedThumbnail.get_or_none(
+        (PackedThumbnail.ytid == ytid) & (PackedThumbnail.size == size)
+    )
+    if entry is None:
+        return None
+    end = entry.offset + entry.length
+    path = pack_path(entry.channel_id)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if stat.st_size < end:
+        return None
+    with _maps_lock:
+        inode, mapped = _maps.get(entry.channel_id, (None, None))
+        # the pack only grows, so the old map is still good for what it covers,
+        # unless the pack was deleted and made again.
+        if mapped is None or inode != stat.st_ino or len(mapped) < end:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # not closing the old map, since another thread might be reading it.
+            _maps[entry.channel_id] = (stat.st_ino, mapped)
+    return mapped[entry.offset : end]
+
+
+class _Index:
+    """
+    ytid -> {size: offset} of what's packed, for the video cards.
+    the offset changes when a thumbnail is replaced, so it's a good URL version.
+    like file_index, it's cached and only reloaded when something was added or removed,
+    including by the other process.
+    """
+
+    def __init__(self):
+        self._sizes: Dict[str, Dict[str, int]] = {}
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            if time.time() - self._checked_at < file_index.CHECK_INTERVAL:
+                return
+            # replacing a thumbnail keeps its row but moves its offset forward
+            version = (
+                PackedThumbnail.select(
+                    fn.MAX(PackedThumbnail.id),
+                    fn.COUNT(PackedThumbnail.id),
+                    fn.SUM(PackedThumbnail.offset),
+                )
+                .tuples()
+                .get()
+            )
+            if version != self._version:
+                sizes = {}
+                for ytid, size, offset in PackedThumbnail.select(
+                    PackedThumbnail.ytid, PackedThumbnail.size, PackedThumbnail.offset
+                ).tuples():
+                    sizes.setdefault(ytid, {})[size] = offset
+                self._sizes = sizes
+                self._version = version
+            self._checked_at = time.time()
+
+    def sizes(self, ytid) -> Dict[str, int]:
+        self.refresh()
+        return self._sizes.get(ytid, {})
+
+    def ytids(self, size=FULL) -> set:
+        self.refresh()
+        return {ytid for ytid, sizes in self._sizes.items() if size in sizes}
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = 0
+
+
+index = _Index()
+
+
+def missing_small() -> list:
+    """[(channel_id, ytid)] of packed thumbnails that don't have a small version"""
+    small = PackedThumbnail.alias()
+    return list(
+        PackedThumbnail.select(PackedThumbnail.channel_id, PackedThumbnail.ytid)
+        .join(
+            small,
+            JOIN.LEFT_OUTER,
+            on=(small.ytid == PackedThumbnail.ytid) & (small.size == SMALL),
+        )
+        .where((PackedThumbnail.size == FULL) & small.id.is_null())
+        .order_by(PackedThumbnail.channel_id, PackedThumbnail.offset)
+        .tuples()
+    )
+
+
+def pack_directories():
+    """
+    moves the thumbnails in thumbnails/ and thumbnails_small/ into packs.
+    each file is deleted once it's in a pack.
+    """
+    num_packed = 0
+    for size, root in _ROOTS.items():
+        if not root.exists():
+            continue
+        for channel_dir in sorted(root.iterdir()):
+            if not channel_dir.is_dir():
+                continue
+            paths = sorted(channel_dir.glob('*.jpg'))
+            for batch in chunked(paths, _BATCH_SIZE):
+                add_many(
+                    channel_dir.name,
+                    [(path.stem, size, path.read_bytes()) for path in batch],
+                )
+                for path in batch:
+                    path.unlink()
+                num_packed += len(batch)
+            try:
+                channel_dir.rmdir()
+            except OSError:
+                # something else is still in there
+                pass
+    file_index.thumbnails.invalidate()
+    file_index.small_thumbnails.invalidate()
+    index.invalidate()
+    common.print_function(f"Packed {num_packed} thumbnails")
+
+
+def unpack_to_directories():
+    """
+    the reverse of pack_directories, e.g. to go back to the regular folders.
+    if thumbnail_packs is still on in settings.toml, new thumbnails still go into packs.
+    """
+    num_unpacked = 0
+    channel_ids = [
+        channel_id
+        for (channel_id,) in PackedThumbnail.select(PackedThumbnail.channel_id)
+        .distinct()
+        .tuples()
+    ]
+    for channel_id in channel_ids:
+        entries = list(
+            PackedThumbnail.select()
+            .where(PackedThumbnail.channel_id == channel_id)
+            # in the order they're in the file, so it's read sequentially
+            .order_by(PackedThumbnail.offset)
+        )
+        path = pack_path(channel_id)
+        with open(path, 'rb') as f:
+            for entry in entries:
+                f.seek(entry.offset)
+                content = f.read(entry.length)
+                common.write_file(
+                    _ROOTS[entry.size].joinpath(channel_id, f'{entry.ytid}.jpg'),
+                    content,
+                )
+        num_unpacked += len(entries)
+        with db.atomic(lock_type='IMMEDIATE'):
+            # only the ones we wrote, in case one was added in the meantime
+            for batch in chunked([entry.id for entry in entries], 500):
+                PackedThumbnail.delete().where(PackedThumbnail.id.in_(batch)).execute()
+            if not PackedThumbnail.select().where(
+                PackedThumbnail.channel_id == channel_id
+            ).exists():
+                try:
+                    path.unlink()
+                except PermissionError:
+                    # on Windows, the web server might still have it mapped.
+                    # it's harmless to leave, since new thumbnails get appended to it.
+                    pass
+    file_index.thumbnails.invalidate()
+    file_index.small_thumbnails.invalidate()
+    index.invalidate()
+    common.print_function(f"Unpacked {num_unpacked} thumbnails")
@@ -0,0 +1,72 @@
+"""
+Lets the web process tell the worker that it just queued a task,
+so the worker doesn't have to keep polling the QueuedTask table.
+
+It's a UDP datagram to localhost, so notify() never blocks,
+and nothing goes wrong if the worker isn't running.
+The worker still polls occasionally in case it missed a message,
+e.g. if it was restarted in between.
+"""
+
+import select
+import socket
+import time
+
+from . import common
+
+HOST = '127.0.0.1'
+
+# how often the worker checks the queue even if nobody woke it up
+FALLBACK_POLL_INTERVAL = 60
+# if we can't listen (e.g. the port is taken), poll like we used to
+POLL_INTERVAL_WITHOUT_WAKEUP = 5
+
+
+def notify():
+    """
+    call this after the transaction that queued the task has committed,
+    otherwise the worker might look before the task is there.
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'x', (HOST, common.WORKER_PORT))
+    except OSError:
+        pass
+
+
+class Listener:
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind((HOST, common.WORKER_PORT))
+        except OSError as exc:
+            common.print_function(
+                f"Can't listen on port {common.WORKER_PORT} ({exc}), "
+                f"will check for new tasks every {POLL_INTERVAL_WITHOUT_WAKEUP} seconds"
+            )
+            self.sock.close()
+            self.sock = None
+            return
+        self.sock.setblocking(False)
+
+    def wait(self, timeout=None):
+        """returns when notified, or when it's time to poll anyway"""
+        if self.sock is None:
+            max_timeout = POLL_INTERVAL_WITHOUT_WAKEUP
+        else:
+            max_timeout = FALLBACK_POLL_INTERVAL
+        timeout = min(timeout or max_timeout, max_timeout)
+        if self.sock is None:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if readable:
+            self._drain()
+
+    def _drain(self):
+        # several tasks may have been queued at once; one check covers them all.
+        while True:
+            try:
+                self.sock.recv(64)
+            except (BlockingIOError, ConnectionResetError):
+                return
@@ -1,40 +1,171 @@
 from . import common
 import asyncio
+import random
+import aiohttp
 from aiohttp import ClientSession
 import re
-from urllib.request import urlopen
 from urllib.parse import urlencode, urlparse
 import urllib
 from icecream import ic
 import json
-import urllib.error
+from datetime import datetime
 from .common import YOUTUBE_API_KEY
 from pathlib import Path
+from typing import Optional
 
 print_function = print
 
 scopes = ["https://www.googleapis.com/auth/youtube.readonly"]
 
+API_URL = "https://www.googleapis.com/youtube/v3"
+
+# total includes reading the body. API responses are small,
+# so if it takes this long something is wrong and we should retry.
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+MAX_ATTEMPTS = 4
+# seconds; doubles after each failed attempt
+RETRY_BACKOFF = 1
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# one session for the whole process, so that connections to the API
+# are kept alive and reused, rather than a new TLS handshake per request.
+_session: Optional[ClientSession] = None
+
+
+def get_session() -> ClientSession:
+    """must be called from inside the event loop that will use it"""
+    global _session
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60),
+            timeout=REQUEST_TIMEOUT,
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+# quota units per call. all the list methods we use cost 1.
+# https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS = dict(channels=1, playlistItems=1, videos=1)
+
+QUOTA_ERROR_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+
+
+class APIError(Exception):
+    def __init__(self, code, data):
+        super().__init__(code, data)
+        self.code = code
+        self.data = data
+
+
+class QuotaExceededError(APIError):
+    pass
+
+
+def is_quota_error(data):
+    try:
+        reasons = [e.get('reason') for e in data['error']['errors']]
+    except (KeyError, TypeError):
+        return False
+    return bool(QUOTA_ERROR_REASONS.intersection(reasons))
+
+
+def estimate_quota_cost(num_pages):
+    """channels call, then a playlistItems and a videos call per page"""
+    return QUOTA_COSTS['channels'] + num_pages * (
+        QUOTA_COSTS['playlistItems'] + QUOTA_COSTS['videos']
+    )
+
+
+async def yt_request(resource, params):
+    # models imports this module
+    from .models import ApiCache, QuotaLedger, RateLimiter, now_unix
+
+    # the database calls go through to_thread, since they can wait on
+    # SQLite's lock (e.g. while the worker is writing) and would block the event loop.
+    cache_key = ApiCache.make_key(resource, params)
+    cached = await asyncio.to_thread(ApiCache.get_or_none, ApiCache.key == cache_key)
+    headers = {}
+    if cached:
+        ttl = common.API_CACHE_TTLS.get(resource, 0)
+        if now_unix() - cached.fetched_epoch < ttl:
+            return json.loads(cached.body)
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+
+    if await asyncio.to_thread(QuotaLedger.remaining_today) <= 0:
+        raise QuotaExceededError(403, "Daily API quota used up (see the status page)")
 
-def yt_request(resource, params):
     params = dict(params, key=YOUTUBE_API_KEY)
     querystring = urlencode(params)
-    url = f"https://www.googleapis.com/youtube/v3/{resource}?{querystring}"
-    try:
-        with urlopen(url) as resp:
-            return json.loads(resp.read())
-    except urllib.error.HTTPError as e:
-        print_function(e.code)
-        print_function(json.loads(e.read()))
-        raise
+    url = f"{API_URL}/{resource}?{querystring}"
+    session = get_session()
+    for attempt in range(MAX_ATTEMPTS):
+        is_last_attempt = attempt == MAX_ATTEMPTS - 1
+        delay = RETRY_BACKOFF * 2**attempt * random.uniform(1, 1.5)
+        await asyncio.sleep(
+            await asyncio.to_thread(
+                RateLimiter.reserve,
+                'youtube_api',
+                rate=common.API_REQUESTS_PER_SECOND,
+                burst=common.API_REQUESTS_PER_SECOND * 2,
+            )
+        )
+        try:
+            async with session.get(url, headers=headers) as resp:
+                # we don't know for sure which responses YouTube charges for,
+                # so count them all to be safe.
+                await asyncio.to_thread(
+                    QuotaLedger.record, resource, QUOTA_COSTS.get(resource, 1)
+                )
+                if resp.status == 304 and cached:
+                    # unchanged, so just mark it as fresh again
+                    cached.fetched_epoch = now_unix()
+                    await asyncio.to_thread(cached.save)
+                    return json.loads(cached.body)
+                if resp.status == 200:
+                    body = await resp.text()
+                    data = json.loads(body)
+                    etag = resp.headers.get('ETag')
+                    if not etag and data.get('etag'):
+                        etag = f'"{data["etag"]}"'
+                    await asyncio.to_thread(
+                        ApiCache.store, cache_key, resource, etag, body
+                    )
+                    return data
+                try:
+                    data = await resp.json(content_type=None)
+                except ValueError:
+                    data = await resp.text()
+                if resp.status == 403 and is_quota_error(data):
+                    await asyncio.to_thread(QuotaLedger.mark_exhausted)
+                    raise QuotaExceededError(resp.status, data)
+                if resp.status not in RETRY_STATUSES or is_last_attempt:
+                    print_function(resp.status)
+                    print_function(data)
+                    raise APIError(resp.status, data)
+                retry_after = resp.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as exc:
+            if is_last_attempt:
+                raise
+            print_function(f"{resource} request failed ({exc!r}), retrying")
+        await asyncio.sleep(delay)
 
 
 class ChannelNotFoundError(Exception):
     pass
 
 
-def get_channel(**kwargs):
-    resp = yt_request(
+async def get_channel(**kwargs):
+    resp = await yt_request(
         'channels', dict(part="snippet,contentDetails,statistics", **kwargs)
     )
     try:
@@ -62,15 +193,36 @@ class Text:
 YOUTUBE_VIDEOS_PER_PAGE = 50
 
 
-async def list_videos_by_page(channel_id):
+def published_at(item) -> datetime:
+    """of a video resource, in UTC, like Video.published_at"""
+    # it ends with Z, which fromisoformat doesn't take before 3.11
+    return datetime.fromisoformat(item['snippet']['publishedAt'][:-1])
+
 
-    channel = get_channel(id=channel_id)
+async def list_videos_by_page(
+    channel_id,
+    find_known_ytids=None,
+    newest_known_ytid=None,
+    newest_known_published_at: Optional[datetime] = None,
+):
+    """
+    For an incremental update, pass find_known_ytids, a function that
+    takes a list of ytids and returns the ones that are already in the library.
+    It stops at the first page that is all known videos
+    (without fetching their details),
+    or after the page that has newest_known_ytid, since everything after it is older.
+    If that video is gone from the channel, newest_known_published_at
+    does the same: it stops after the first page that reaches it.
+    Otherwise it goes through all the channel's uploads.
+    """
+
+    channel = await get_channel(id=channel_id)
     playlistId = channel['contentDetails']['relatedPlaylists']['uploads']
     pageToken = ''
     num_processed = 0
 
     while True:
-        resp = yt_request(
+        resp = await yt_request(
             'playlistItems',
             dict(
                 part="snippet,status,contentDetails",
@@ -84,7 +236,14 @@ async def list_videos_by_page(channel_id):
         pageToken = resp.get('nextPageToken')
 
         ids = [item['contentDetails']['videoId'] for item in resp['items']]
-        resp = yt_request(
+        if not ids:
+            break
+        if find_known_ytids:
+            # it queries the DB
+            known_ytids = await asyncio.to_thread(find_known_ytids, ids)
+            if len(known_ytids) == len(ids):
+                break
+        resp = await yt_request(
             'videos',
             dict(
                 part="snippet,status,contentDetails,statistics,player",
@@ -98,7 +257,10 @@ async def list_videos_by_page(channel_id):
 
         ytids = [d1['id'] for d1 in items]
 
-        await common.download_video_thumbnails(channel_id, ytids)
+        placeholders = await common.download_video_thumbnails(channel_id, ytids)
+        # the videos aren't in the DB yet, so pass these along to ingest_page
+        for item in items:
+            item['thumbnail_placeholder'] = placeholders.get(item['id'])
 
         yield items
 
@@ -107,15 +269,75 @@ async def list_videos_by_page(channel_id):
 
         if num_processed == total_num_results:
             break
+        if find_known_ytids and newest_known_ytid in ids:
+            break
+        if (
+            find_known_ytids
+            and newest_known_published_at
+            and any(
+                published_at(item) <= newest_known_published_at for item in items
+            )
+        ):
+            break
+        if not pageToken:
+            break
+
+
+async def merge_page_generators(generators: dict, concurrency, max_rounds=None):
+    """
+    Takes {key: async generator of pages} (e.g. one list_videos_by_page per channel),
+    runs up to `concurrency` of them at a time,
+    and yields (key, page, exception) in the order pages arrive.
+
+    It goes in rounds: every generator gets its next page before any generator
+    gets the page after that, so the results have variety across all channels,
+    the same as going through them round-robin.
+    A generator that raises is dropped after its exception is yielded.
+    When a generator is exhausted, (key, None, None) is yielded.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def next_page(key, gen):
+        async with semaphore:
+            try:
+                return key, await gen.__anext__(), None
+            except StopAsyncIteration:
+                return key, None, None
+            except Exception as exc:
+                return key, None, exc
+
+    active = dict(generators)
+    num_rounds = 0
+    try:
+        while active and (max_rounds is None or num_rounds < max_rounds):
+            # create them in order so that the semaphore lets the first keys go first.
+            tasks = [asyncio.ensure_future(next_page(k, g)) for k, g in active.items()]
+            try:
+                for future in asyncio.as_completed(tasks):
+                    key, page, exc = await future
+                    if page is None:
+                        del active[key]
+                    yield key, page, exc
+            finally:
+                # if the consumer stopped early, e.g. the browser tab was closed
+                for task in tasks:
+                    task.cancel()
+            num_rounds += 1
+    finally:
+        for gen in active.values():
+            try:
+                await gen.aclose()
+            except (Exception, asyncio.CancelledError):
+                pass
 
 
-def get_channel_from_video_url(url):
+async def get_channel_from_video_url(url):
     parsed = urlparse(url)
     # breakpoint()
     ytid = urllib.parse.parse_qs(parsed.query)['v'][0]
-    resp = yt_request('videos', dict(part='snippet', id=ytid))
+    resp = await yt_request('videos', dict(part='snippet', id=ytid))
     channel_id = resp['items'][0]['snippet']['channelId']
-    channel_data = get_channel(id=channel_id)
+    channel_data = await get_channel(id=channel_id)
     return dict(
         id=channel_data['id'],
         name=channel_data['snippet']['title'],
@@ -0,0 +1,94 @@
+"""
+Runs yt-dlp inside the worker process, instead of starting a new yt-dlp
+process for every video.
+
+Starting yt-dlp means starting a Python interpreter, importing all the extractors,
+and fetching and deciphering YouTube's player JS.
+Here, each service thread keeps one YoutubeDL for its whole life,
+so after the first video all of that is already loaded and cached in memory.
+
+Jobs are fed to the threads through a queue.
+YoutubeDL isn't thread-safe, so each instance is only used by its own thread.
+"""
+
+import queue
+import shlex
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+import yt_dlp
+
+EXTRACT_OPTS = dict(quiet=True, no_warnings=True)
+
+
+def _parse_flags(flags) -> dict:
+    """yt-dlp command line flags, either a string or a list, to YoutubeDL options"""
+    if isinstance(flags, str):
+        flags = shlex.split(flags)
+    return yt_dlp.parse_options(list(flags)).ydl_opts
+
+
+class YtdlService:
+    def __init__(self, num_threads, flags=()):
+        """
+        flags are the yt-dlp command line flags to extract with,
+        e.g. --cookies, so that the same videos work here as with the CLI.
+        """
+        self.num_threads = num_threads
+        self.flags = flags
+        self._jobs = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # lazily, so that the web process doesn't start threads it won't use.
+        with self._lock:
+            while len(self._threads) < self.num_threads:
+                thread = threading.Thread(target=self._thread_main, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _thread_main(self):
+        ydl = yt_dlp.YoutubeDL(dict(_parse_flags(self.flags), **EXTRACT_OPTS))
+        while True:
+            fxn, args, future = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fxn(ydl, *args))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def submit(self, fxn, *args) -> Future:
+        """fxn gets called with the thread's YoutubeDL and args"""
+        self._start()
+        future = Future()
+        self._jobs.put((fxn, args, future))
+        return future
+
+    def extract_info(self, url) -> dict:
+        """raises yt_dlp.utils.DownloadError if it fails"""
+        return self.submit(_extract_info, url).result()
+
+    def download(self, info_path: Path, flags):
+        """
+        flags are yt-dlp command line flags, either a string or a list,
+        so that the same flags work here and with the yt-dlp CLI.
+        """
+        return self.submit(_download, info_path, flags).result()
+
+
+def _extract_info(ydl: yt_dlp.YoutubeDL, url):
+    info = ydl.extract_info(url, download=False)
+    return ydl.sanitize_info(info)
+
+
+def _download(ydl: yt_dlp.YoutubeDL, info_path: Path, flags):
+    # the download options differ per job, so it needs its own YoutubeDL.
+    # that's cheap now, since the info is already extracted and
+    # everything is already imported.
+    with yt_dlp.YoutubeDL(_parse_flags(flags)) as downloader:
+        retcode = downloader.download_with_info_file(str(info_path))
+    if retcode:
+        raise yt_dlp.utils.DownloadError(f"yt-dlp failed for {info_path}")
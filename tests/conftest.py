@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# the package isn't installed for the tests
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath('src')))
+
+# ytcl treats the current directory as the library, and connects to its
+# db.sqlite3 as soon as it's imported, so give it an empty one.
+os.chdir(tempfile.mkdtemp())
@@ -0,0 +1,96 @@
+"""
+the pages that list videos from many channels should make the same number
+of queries however many videos they show, see with_channels.
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from starlette.requests import Request
+
+from ytcl import Downloads, RecentlyPublished, Search
+from ytcl.models import (
+    Channel,
+    IgnoreTerm,
+    PackedThumbnail,
+    QueuedTask,
+    Video,
+    VideoSearch,
+    create_search_triggers,
+    db,
+)
+
+NUM_VIDEOS = 20
+
+
+@pytest.fixture
+def library():
+    db.init(':memory:')
+    db.create_tables(
+        [Channel, Video, IgnoreTerm, QueuedTask, VideoSearch, PackedThumbnail]
+    )
+    create_search_triggers()
+    yield
+    db.close()
+
+
+def add_videos(start, stop):
+    # each from its own channel, so that loading the channels one card
+    # at a time would show up as extra queries
+    for i in range(start, stop):
+        channel = Channel.create(id=f'UC{i}', name=f'channel {i}', thumbnail_url='')
+        Video.create(
+            ytid=f'video{i:06d}',
+            channel=channel,
+            title=f'travel vlog {i}',
+            published_at=datetime(2024, 1, 1) - timedelta(days=i),
+            duration=60,
+            yt_view_count=1000,
+            yt_like_count=10,
+            download_status_epoch=i + 1,
+        )
+
+
+def count_queries(monkeypatch, endpoint, query_string=''):
+    scope = dict(
+        type='http',
+        method='GET',
+        path='/',
+        query_string=query_string.encode(),
+        headers=[],
+    )
+    queries = []
+    execute_sql = db.execute_sql
+
+    def counting_execute_sql(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, 'execute_sql', counting_execute_sql)
+    try:
+        response = endpoint(scope, None, None).get(Request(scope))
+    finally:
+        monkeypatch.undo()
+    assert response.status_code == 200
+    return len(queries), response.body.decode('utf8')
+
+
+@pytest.mark.parametrize(
+    'endpoint, query_string',
+    [
+        (Search, 'search_term=travel'),
+        (RecentlyPublished, ''),
+        (Downloads, ''),
+    ],
+)
+def test_queries_dont_grow_with_videos(library, monkeypatch, endpoint, query_string):
+    add_videos(0, 1)
+    # the first time fills caches like file_index
+    count_queries(monkeypatch, endpoint, query_string)
+    num_queries, html = count_queries(monkeypatch, endpoint, query_string)
+    assert 'video000000' in html
+
+    add_videos(1, NUM_VIDEOS)
+    num_queries_many, html = count_queries(monkeypatch, endpoint, query_string)
+    assert f'video{NUM_VIDEOS - 1:06d}' in html
+    assert num_queries_many == num_queries